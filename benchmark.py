@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of jumpplusext, run against local test servers
+
+用法：
+benchmark.py pool [PAGES] [THREADS]
+    比較預設與調整後連線池的連線數（握手次數）與吞吐量
+benchmark.py descramble [GRID] [PAGES]
+    比較逐塊draw_image()與draw_tiles()、descramble_grid()重排GRID x GRID圖塊的速度
+benchmark.py mock [EPISODES] [PAGES] [LATENCY_MS] [ERROR_RATE] [SIZE_KB] [ENGINES]
+    對模擬Jump+伺服器下載EPISODES章各PAGES頁，比較各引擎（thread,process,async）的
+    每秒頁數、每頁延遲p50/p99與記憶體峰值。ERROR_RATE為回應503的機率
+benchmark.py packed [PAGES] [LATENCY_MS] [SIZE_KB] [THREADS]
+    比較逐頁下載與packedImage一次下載PAGES頁單行本的速度，並測試打包圖片無效時改為逐頁下載
+benchmark.py autotune [PAGES] [LATENCY_MS] [CAPACITY] [THREADS]
+    對同時只處理CAPACITY個圖片請求的伺服器，比較固定執行緒數與autotune的每秒頁數、每頁延遲p50與最後並行數
+benchmark.py catalog [EPISODES] [ROUNDS]
+    以EPISODES話的模擬章節列表，比較json與orjson解析及建立章節列表的時間，與有無__slots__的Chapter記憶體用量
+"""
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+from pathlib import Path
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+import httpx
+
+import jumpplusext
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serve fixed-size fake images over keep-alive HTTP/1.1"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.server.image
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class CountingServer(ThreadingHTTPServer):
+    """HTTP server counting accepted TCP connections, each one is a handshake"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.005, image_size=200 * 1024):
+        super().__init__(('127.0.0.1', 0), ImageHandler)
+        self.latency = latency
+        self.image = bytes(image_size)
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+class MockJumpPlus:
+    """Stand-in of Jump+ GraphQL API and image server for httpx.MockTransport,
+    serving one series of synthetic episodes
+
+    :param episodes: number of episodes
+    :param pages: number of pages of each episode
+    :param latency: seconds before each response
+    :param error_rate: probability of responding 503
+    :param image_size: bytes of each image
+    :param packed: zip, broken (not ZIP) or None (no packedImage)
+    :param capacity: number of images served at once, further image requests wait, 0 for unlimited
+    """
+
+    def __init__(self, episodes=20, pages=20, latency=0.02, error_rate=0.0, image_size=200 * 1024, packed='zip', capacity=0):
+        self.episodes = episodes
+        self.pages = pages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.image = random.randbytes(image_size)
+        # zip, broken (not ZIP) or None (no packedImage)
+        self.packed = packed
+        self.packed_image = None
+        self.capacity = threading.Semaphore(capacity) if capacity else None
+
+    def episode(self, number):
+        return {
+            'id': f'Episode:{number}', 'databaseId': str(number), 'title': f'第{number}話', 'subtitle': None,
+            'number': number, 'pageImageToken': 'token', 'series': {'id': 'Series:bench', 'title': 'bench'},
+            'purchaseInfo': {'isFree': True, 'hasRented': False, 'hasPurchased': False, 'purchasableViaOnetimeFree': False},
+            'pageImages': {'totalCount': self.pages, 'edges': [
+                {'node': {'src': f'https://cdn.bench.test/{number}/{page}.jpg'}} for page in range(self.pages)]},
+        }
+
+    def volume(self, number):
+        volume = self.episode(number)
+        volume['pageImages']['edges'] = [{'node': {'src': f'https://cdn.bench.test/v{number}/{page}.jpg'}} for page in range(self.pages)]
+        volume['packedImage'] = {'url': f'https://cdn.bench.test/packed/v{number}.zip'} if self.packed else None
+        return volume
+
+    def get_packed_image(self):
+        if self.packed == 'broken':
+            return self.image
+        if self.packed_image is None:
+            f = io.BytesIO()
+            with zipfile.ZipFile(f, 'w') as archive:
+                for page in range(self.pages):
+                    archive.writestr(f'{page + 1}.jpg', self.image)
+            self.packed_image = f.getvalue()
+        return self.packed_image
+
+    def graphql(self, request):
+        body = json.loads(request.content)
+        variables = body.get('variables') or {}
+        operation = body.get('operationName')
+        if operation == 'SeriesDetailEpisodeList':
+            offset, first = variables.get('episodeOffset', 0), variables.get('episodeFirst', 100)
+            edges = [{'node': self.episode(i)} for i in range(offset + 1, min(offset + first, self.episodes) + 1)]
+            connection = {'totalCount': self.episodes, 'pageInfo': {'hasNextPage': offset + first < self.episodes}, 'edges': edges}
+            return {'data': {'series': {'episodes': connection}}}
+        if operation == 'SeriesDetailVolumeList':
+            return {'data': {'series': {'volumes': {'totalCount': 0, 'pageInfo': {'hasNextPage': False}, 'edges': []}}}}
+        if operation == 'ChapterBatch':
+            data = {}
+            for name, chapter_id in variables.items():
+                data['e' + name[2:]] = self.episode(int(chapter_id))
+                data['v' + name[2:]] = None
+            return {'data': data}
+        if operation == 'VolumeViewer':
+            return {'data': {'volume': self.volume(int(variables['volumeID']))}}
+        if operation in ('EpisodeViewer', 'EpisodeViewerConditionallyCacheable'):
+            return {'data': {'episode': self.episode(int(variables['episodeID']))}}
+        return {'data': None, 'errors': [{'message': f'unknown operation {operation}'}]}
+
+    def respond(self, request):
+        if random.random() < self.error_rate:
+            return httpx.Response(503, headers={'Retry-After': '0'})
+        if request.url.host == 'cdn.bench.test':
+            if request.url.path.startswith('/packed/'):
+                return httpx.Response(200, content=self.get_packed_image())
+            return httpx.Response(200, content=self.image)
+        return httpx.Response(200, json=self.graphql(request))
+
+    def handler(self, request):
+        if self.capacity and request.url.host == 'cdn.bench.test':
+            with self.capacity:
+                time.sleep(self.latency)
+        else:
+            time.sleep(self.latency)
+        return self.respond(request)
+
+    async def async_handler(self, request):
+        await asyncio.sleep(self.latency)
+        return self.respond(request)
+
+class BenchExtractor(jumpplusext.Extractor):
+    """Extractor sending all requests to MockJumpPlus"""
+
+    mock = MockJumpPlus()
+    # Bytes of each image processed by pure Python decrypt_image()
+    decrypt_bytes = 20000
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.headers = {}
+
+    def make_client(self, asynchronous=False):
+        if asynchronous:
+            return httpx.AsyncClient(transport=httpx.MockTransport(self.mock.async_handler))
+        return httpx.Client(transport=httpx.MockTransport(self.mock.handler))
+
+    def decrypt_image(self, encrypted, idx, image_url, decrypt_info):
+        # CPU-bound work holding GIL, like descrambling in pure Python
+        head = bytes(b ^ 0x55 for b in encrypted[:self.decrypt_bytes])
+        return head + encrypted[len(head):]
+
+def new_extractor(config, cls=jumpplusext.Extractor):
+    """Create extractor with config overridden, and a fresh download pool"""
+    jumpplusext.ExtractorBase.pool = None
+    return cls(config)
+
+def download_pages(extractor, base_url, pages):
+    """Download pages with extractor, return elapsed seconds"""
+    with tempfile.TemporaryDirectory() as root:
+        image_download = jumpplusext.ImageDownload(root, 'bench', 'chapter')
+        for i in range(pages):
+            image_download.requests.append(extractor.client.build_request('GET', f'{base_url}/{i}.jpg'))
+        start = time.perf_counter()
+        extractor.download_list(image_download)
+        elapsed = time.perf_counter() - start
+        assert len(list(Path(root).rglob('*.jpg'))) == pages
+    jumpplusext.ExtractorBase.pool.shutdown()
+    return elapsed
+
+def bench_pool(pages=2000, threads=32):
+    configs = [
+        # httpx defaults, as before connection pool options were added
+        ('httpx預設', {'threads': threads, 'max_keepalive_connections': 20, 'keepalive_expiry': 5.0}),
+        ('調整後', {'threads': threads, 'max_keepalive_connections': 0, 'keepalive_expiry': 30.0}),
+    ]
+    print(f'{pages}頁，{threads}執行緒')
+    for label, config in configs:
+        server = CountingServer()
+        base_url = server.start()
+        elapsed = download_pages(new_extractor(config), base_url, pages)
+        server.shutdown()
+        print(f'{label}: 連線數 {server.connections}，{pages / elapsed:.1f} 頁/秒')
+
+def bench_descramble(grid=4, pages=50):
+    import numpy
+    from PIL import Image
+
+    extractor = jumpplusext.Extractor()
+    width, height = 1200, 1700
+    src = Image.frombytes('RGB', (width, height), random.randbytes(width * height * 3))
+    src_array = numpy.asarray(src)
+    tile_width, tile_height = width // grid, height // grid
+    permutation = list(range(grid * grid))
+    random.shuffle(permutation)
+    tiles = [(j % grid * tile_width, j // grid * tile_height, tile_width, tile_height,
+              i % grid * tile_width, i // grid * tile_height) for i, j in enumerate(permutation)]
+
+    def per_tile():
+        dest = src.copy()
+        for tile in tiles:
+            extractor.draw_image(src, dest, *tile)
+        return dest
+
+    def draw_tiles_array():
+        dest = src_array.copy()
+        extractor.draw_tiles(src_array, dest, tiles)
+        return dest
+
+    def descramble_grid_array():
+        return extractor.descramble_grid(src_array, grid, grid, permutation)
+
+    def descramble_grid_converted():
+        # Page decoded by PIL, converted to array and back
+        return Image.fromarray(extractor.descramble_grid(numpy.asarray(src), grid, grid, permutation))
+
+    expected = per_tile().tobytes()
+    print(f'{width}x{height}，{grid}x{grid}圖塊，{pages}頁')
+    for label, function in [('逐塊draw_image (PIL)', per_tile),
+                            ('draw_tiles (NumPy)', draw_tiles_array),
+                            ('descramble_grid (NumPy)', descramble_grid_array),
+                            ('descramble_grid (PIL轉NumPy再轉回)', descramble_grid_converted)]:
+        assert numpy.asarray(function()).tobytes() == expected
+        start = time.perf_counter()
+        for _ in range(pages):
+            function()
+        elapsed = time.perf_counter() - start
+        print(f'{label}: 每頁{elapsed / pages * 1000:.2f}毫秒')
+
+# Config of each engine compared by bench_mock()
+MOCK_ENGINES = {
+    'thread': {'threads': 16},
+    'process': {'threads': 16, 'decrypt_processes': 4},
+    'async': {'threads': 4, 'engine': 'async', 'async_concurrency': 64},
+}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def run_mock(engine, episodes, pages, latency, error_rate, image_size):
+    """Download all episodes from MockJumpPlus with engine, print result as JSON.
+    Run in its own process by bench_mock(), so peak memory is of one engine"""
+    BenchExtractor.mock = MockJumpPlus(episodes, pages, latency, error_rate, image_size)
+    with tempfile.TemporaryDirectory() as root:
+        metrics_file = Path(root, 'metrics.jsonl')
+        config = dict(MOCK_ENGINES[engine], metrics_file=str(metrics_file), retries=50, retry_backoff=0.01, retry_budget=1 << 30)
+        extractor = new_extractor(config, BenchExtractor)
+        start = time.perf_counter()
+        extractor.download_chapters(extractor.seq_jobs(['bench'], '1-r1', str(Path(root, 'download'))))
+        elapsed = time.perf_counter() - start
+        extractor.metrics.close()
+        if jumpplusext.ExtractorNoChapterBase.decrypt_pool:
+            # Wait for decrypt processes, so their memory is counted
+            jumpplusext.ExtractorNoChapterBase.decrypt_pool.shutdown()
+        with metrics_file.open(encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+    latencies = [r['seconds'] for r in records if r['type'] == 'page' and r['status'] == 'downloaded']
+    memory = None
+    if resource:
+        # KiB on Linux, decrypt processes are counted separately
+        memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'pages': len(latencies), 'expected': episodes * pages, 'seconds': elapsed,
+                      'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'memory': memory}))
+
+def bench_mock(episodes=20, pages=20, latency_ms=20, error_rate=0.0, size_kb=200, engines='thread,process,async'):
+    print(f'{episodes}章x{pages}頁，延遲{latency_ms}毫秒，錯誤率{error_rate}，每頁{size_kb}KiB')
+    for engine in engines.split(','):
+        output = subprocess.run([sys.executable, __file__, 'mock-run', engine, str(episodes), str(pages),
+                                 str(latency_ms / 1000), str(error_rate), str(size_kb * 1024)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        memory = '-'
+        if result['memory']:
+            memory = f'{result["memory"][0] / 1024:.0f} MiB'
+            if result['memory'][1]:
+                memory += f'（子程序 {result["memory"][1] / 1024:.0f} MiB）'
+        print(f'{engine}: {result["pages"]}/{result["expected"]}頁，{result["pages"] / result["seconds"]:.1f} 頁/秒，'
+              f'p50 {result["p50"] * 1000:.0f}毫秒，p99 {result["p99"] * 1000:.0f}毫秒，記憶體峰值 {memory}')
+
+def bench_packed(pages=200, latency_ms=50, size_kb=200, threads=8):
+    print(f'單行本{pages}頁，延遲{latency_ms}毫秒，每頁{size_kb}KiB，{threads}執行緒')
+    for label, packed, packed_images in [('逐頁', 'zip', False), ('packedImage', 'zip', True),
+                                         ('packedImage無效，改為逐頁', 'broken', True)]:
+        BenchExtractor.mock = MockJumpPlus(pages=pages, latency=latency_ms / 1000, image_size=size_kb * 1024, packed=packed)
+        extractor = new_extractor({'threads': threads, 'packed_images': packed_images}, BenchExtractor)
+        with tempfile.TemporaryDirectory() as root:
+            start = time.perf_counter()
+            extractor.download_list(extractor.prepareVolume('bench', '1', root))
+            elapsed = time.perf_counter() - start
+            images = list(Path(root).rglob('*.jpg'))
+            assert len(images) == pages
+        jumpplusext.ExtractorBase.pool.shutdown()
+        print(f'{label}: {elapsed:.2f}秒，{pages / elapsed:.1f} 頁/秒')
+
+def bench_autotune(pages=2000, latency_ms=20, capacity=8, threads=64):
+    print(f'單行本{pages}頁，延遲{latency_ms}毫秒，伺服器同時處理{capacity}個圖片請求')
+    for label, config in [('固定4執行緒', {'threads': 4}), (f'固定{threads}執行緒', {'threads': threads}),
+                          (f'autotune（上限{threads}）', {'threads': threads, 'autotune': True, 'autotune_interval': 0.2})]:
+        BenchExtractor.mock = MockJumpPlus(pages=pages, latency=latency_ms / 1000, image_size=1024, capacity=capacity)
+        with tempfile.TemporaryDirectory() as root:
+            metrics_file = Path(root, 'metrics.jsonl')
+            extractor = new_extractor(dict(config, metrics_file=str(metrics_file)), BenchExtractor)
+            start = time.perf_counter()
+            extractor.download_list(extractor.prepareVolume('bench', '1', str(Path(root, 'download'))))
+            elapsed = time.perf_counter() - start
+            limit = round(extractor.tuner.limit) if extractor.tuner else config['threads']
+            if extractor.tuner:
+                extractor.tuner.close()
+            extractor.metrics.close()
+            with metrics_file.open(encoding='utf-8') as f:
+                latencies = [r['seconds'] for r in map(json.loads, f) if r['type'] == 'page']
+        jumpplusext.ExtractorBase.pool.shutdown()
+        print(f'{label}: {pages / elapsed:.1f} 頁/秒，p50 {percentile(latencies, 0.5) * 1000:.0f}毫秒，最後並行數 {limit}')
+
+def episode_list_response(offset, first, episodes):
+    """SeriesDetailEpisodeList response with fields of EpisodeListItem, as sent by Jump+"""
+    edges = []
+    for number in range(offset + 1, min(offset + first, episodes) + 1):
+        edges.append({'node': {
+            '__typename': 'Episode', 'id': f'Episode:{number}', 'databaseId': str(10 ** 15 + number),
+            'publisherId': f'pub{number}', 'title': f'第{number}話', 'subtitle': f'サブタイトル{number}',
+            'thumbnailUriTemplate': f'https://cdn.bench.test/thumbnail/{number}/{{height}}x{{width}}.webp',
+            'purchaseInfo': {'__typename': 'PurchaseInfo', 'isFree': number % 3 == 0, 'hasPurchased': number % 3 == 1,
+                             'hasPurchasedViaTicket': False, 'purchasable': True, 'purchasableViaTicket': False,
+                             'purchasableViaPaidPoint': True, 'purchasableViaOnetimeFree': False, 'unitPrice': 50,
+                             'rentable': False, 'rentalEndAt': None, 'hasRented': False,
+                             'rentableByPaidPointOnly': False, 'rentalTermMin': None},
+            'accessibility': 'PURCHASED', 'publishedAt': '2024-01-01T00:00:00Z', 'isSakiyomi': False,
+            'completeReadingInfo': {'visitorCanGetPoint': False, 'gettablePoint': 0}, 'viewCount': 123456,
+            'series': {'id': 'Series:bench', 'databaseId': 'bench', 'publisherId': 'bench', 'title': 'bench',
+                       'serialUpdateScheduleLabel': '毎週月曜更新', 'jamEpisodeWorkType': None},
+            'isViewed': False,
+        }})
+    connection = {'totalCount': episodes, 'pageInfo': {'__typename': 'PageInfo', 'hasNextPage': offset + first < episodes,
+                                                       'endCursor': None}, 'edges': edges}
+    return {'data': {'series': {'__typename': 'Series', 'id': 'Series:bench', 'databaseId': 'bench', 'episodes': connection}}}
+
+class DictChapter:
+    """Chapter with __dict__, as before Chapter had __slots__"""
+
+    def __init__(self, chapter_id, title, locked_status):
+        self.chapter_id = chapter_id
+        self.title = title
+        self.locked_status = locked_status
+
+def bench_catalog(episodes=1000, rounds=20):
+    extractor = jumpplusext.Extractor()
+    page_size = extractor.config['chapter_page_size']
+    # Encoded pages of episode list
+    pages = {offset: json.dumps(episode_list_response(offset, page_size, episodes), ensure_ascii=False).encode()
+             for offset in range(0, episodes, page_size)}
+    empty_volumes = json.dumps({'data': {'series': {'volumes': {'totalCount': 0, 'edges': []}}}}).encode()
+    print(f'{episodes}話，章節列表共{sum(map(len, pages.values())) / 1024:.0f}KiB，{rounds}次')
+    backends = {'json': json.loads}
+    try:
+        import orjson
+        backends['orjson'] = orjson.loads
+    except ImportError:
+        print('未安裝orjson，只測試json')
+    for label, loads in backends.items():
+        def graphql(key, variables):
+            if key == 'SeriesDetailVolumeList':
+                return loads(empty_volumes)
+            return loads(pages[variables['episodeOffset']])
+
+        extractor.graphql = graphql
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for content in pages.values():
+                loads(content)
+        decode = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            chapters = extractor.fetchChapterList('bench')
+        elapsed = (time.perf_counter() - start) / rounds
+        assert len(chapters) == episodes
+        print(f'{label}: 解析{decode * 1000:.2f}毫秒，建立章節列表{elapsed * 1000:.2f}毫秒')
+
+    for label, cls in [('Chapter (__dict__)', DictChapter), ('Chapter (__slots__)', jumpplusext.Chapter)]:
+        tracemalloc.start()
+        chapter_list = [cls(chapter.chapter_id, chapter.title, chapter.locked_status) for chapter in chapters]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del chapter_list
+        print(f'{label}: 每話{size / episodes:.0f}位元組')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+    elif sys.argv[1] == 'pool':
+        bench_pool(*map(int, sys.argv[2:4]))
+    elif sys.argv[1] == 'descramble':
+        bench_descramble(*map(int, sys.argv[2:4]))
+    elif sys.argv[1] == 'mock':
+        types = [int, int, float, float, int, str]
+        bench_mock(*[t(arg) for t, arg in zip(types, sys.argv[2:8])])
+    elif sys.argv[1] == 'packed':
+        bench_packed(*map(int, sys.argv[2:6]))
+    elif sys.argv[1] == 'autotune':
+        bench_autotune(*map(int, sys.argv[2:6]))
+    elif sys.argv[1] == 'catalog':
+        bench_catalog(*map(int, sys.argv[2:4]))
+    elif sys.argv[1] == 'mock-run':
+        types = [str, int, int, float, float, int]
+        run_mock(*[t(arg) for t, arg in zip(types, sys.argv[2:8])])
+    else:
+        print(__doc__)
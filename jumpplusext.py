@@ -1,11 +1,36 @@
 #!/usr/bin/env python3
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor, wait
+import asyncio
+import atexit
+import bisect
+from collections import deque
+import contextlib
+import contextvars
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+import functools
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import json
 import multiprocessing
+import os
 from pathlib import Path
+import queue
+import random
+import re
+import secrets
+import shutil
 import signal
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import zipfile
 
 import httpx
 
@@ -13,20 +38,40 @@ class ExtractorNoChapterBase(ABC):
 
     # Override this for setting extension of downloaded images
     image_extension = None
+    # Override this with True if decrypt_image() needs whole image content.
+    # None means True only if decrypt_image() is overridden, otherwise images
+    # are streamed to file chunk by chunk
+    decrypt_needs_buffer = None
     pool = None
+    # Process pool running decrypt_image(), when decrypt_processes is set
+    decrypt_pool = None
+    # Attributes sent to decrypt_pool processes, decrypt_image() can only use these
+    decrypt_attributes = ('config',)
 
     @abstractmethod
     def name(self):
         """Website name of extractor, for filename of session file"""
         return ''
 
-    def __init__(self):
-        """Create extractor class, read session file"""
+    def __init__(self, config=None):
+        """Create extractor class, read session file and config file
+
+        :param config: options overriding config file, e.g. for tests and benchmarks
+        :type config: dict | None
+        """
 
-        # Override this with ProcessPoolExecutor for multiprocessing
-        self.Executor = ThreadPoolExecutor
+        # Override this with ThreadPoolExecutor to not share workers fairly between comics
+        self.Executor = FairExecutor
         self.is_interrupted = False
-        self.client = httpx.Client()
+        # comic_id -> (fetch time, chapter list)
+        self.chapter_list_cache = {}
+        self.chapter_list_locks = {}
+        # Guards caches and lazily created objects shared by threads
+        self.lock = threading.Lock()
+        # root -> Manifest
+        self.manifests = {}
+        # download location -> output of chapter being downloaded
+        self.outputs = {}
 
         # 讀取登錄信息
         # Use 0 instead of empty string to avoid LocalProtocolError
@@ -41,7 +86,59 @@ class ExtractorNoChapterBase(ABC):
         # 讀取設定
         self.config = {
             'threads': 4,
-            'retries': 20
+            'retries': 20,
+            'prefetch': 2,
+            'chapter_list_ttl': 600,
+            # thread or async
+            'engine': 'thread',
+            'async_concurrency': 100,
+            'http2': False,
+            'max_connections': 100,
+            # 0 for number of concurrent downloads
+            'max_keepalive_connections': 0,
+            'keepalive_expiry': 30.0,
+            'retry_backoff': 0.5,
+            'retry_backoff_max': 30.0,
+            'retry_statuses': {429, 500, 502, 503, 504},
+            'retry_budget': 100,
+            'manifest': True,
+            'sync_parallelism': 4,
+            # Number of comics fetching chapter list at once in dl-seq and dl-all
+            'chapter_list_parallelism': 4,
+            'chapter_page_size': 100,
+            'chapter_batch': 1,
+            'persisted_queries': False,
+            'graphql_stats': False,
+            # 0 to decrypt images in download threads
+            'decrypt_processes': 0,
+            # directory or cbz
+            'output': 'directory',
+            # Directory of image store shared by download roots, empty to disable
+            'store': '',
+            # Requests per second, 0 for unlimited until server responds 429
+            'rate_limit': 0,
+            # Bytes per second, 0 for unlimited
+            'bandwidth_limit': 0,
+            'progress': False,
+            # File to export metrics to, empty to not export
+            'metrics_file': '',
+            # jsonl or prometheus
+            'metrics_format': 'jsonl',
+            # Maximum images of one comic downloaded at once, 0 for unlimited
+            'comic_max_workers': 0,
+            # Download all pages in one request if website provides packed images
+            'packed_images': False,
+            # Port of local job API of daemon mode
+            'daemon_port': 8723,
+            # Download locations allowed for daemon jobs, separated by os.pathsep.
+            # Empty for working directory of daemon only
+            'daemon_roots': [],
+            # Adjust concurrent image downloads from latency and errors, up to threads (async_concurrency for async engine)
+            'autotune': False,
+            # Seconds between adjustments of autotune
+            'autotune_interval': 1.0,
+            # json or orjson for decoding API responses, auto for orjson if installed
+            'json_backend': 'auto',
         }
         try:
             if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
@@ -60,12 +157,166 @@ class ExtractorNoChapterBase(ABC):
                         self.config['threads'] = int(option[1])
                     elif option[0] == 'retries':
                         self.config['retries'] = int(option[1])
+                    elif option[0] == 'prefetch':
+                        self.config['prefetch'] = int(option[1])
+                    elif option[0] == 'chapter_list_ttl':
+                        self.config['chapter_list_ttl'] = float(option[1])
+                    elif option[0] == 'engine':
+                        self.config['engine'] = option[1]
+                    elif option[0] == 'async_concurrency':
+                        self.config['async_concurrency'] = int(option[1])
+                    elif option[0] == 'http2':
+                        self.config['http2'] = option[1] == '1'
+                    elif option[0] == 'max_connections':
+                        self.config['max_connections'] = int(option[1])
+                    elif option[0] == 'max_keepalive_connections':
+                        self.config['max_keepalive_connections'] = int(option[1])
+                    elif option[0] == 'keepalive_expiry':
+                        self.config['keepalive_expiry'] = float(option[1])
+                    elif option[0] == 'retry_backoff':
+                        self.config['retry_backoff'] = float(option[1])
+                    elif option[0] == 'retry_backoff_max':
+                        self.config['retry_backoff_max'] = float(option[1])
+                    elif option[0] == 'retry_statuses':
+                        self.config['retry_statuses'] = {int(i) for i in option[1].split(',')}
+                    elif option[0] == 'retry_budget':
+                        self.config['retry_budget'] = int(option[1])
+                    elif option[0] == 'manifest':
+                        self.config['manifest'] = option[1] == '1'
+                    elif option[0] == 'sync_parallelism':
+                        self.config['sync_parallelism'] = int(option[1])
+                    elif option[0] == 'chapter_list_parallelism':
+                        self.config['chapter_list_parallelism'] = int(option[1])
+                    elif option[0] == 'chapter_page_size':
+                        if int(option[1]) < 1:
+                            # Pagination would never advance
+                            print('chapter_page_size必須大於0，使用預設值')
+                        else:
+                            self.config['chapter_page_size'] = int(option[1])
+                    elif option[0] == 'chapter_batch':
+                        self.config['chapter_batch'] = int(option[1])
+                    elif option[0] == 'persisted_queries':
+                        self.config['persisted_queries'] = option[1] == '1'
+                    elif option[0] == 'graphql_stats':
+                        self.config['graphql_stats'] = option[1] == '1'
+                    elif option[0] == 'decrypt_processes':
+                        self.config['decrypt_processes'] = int(option[1])
+                    elif option[0] == 'output':
+                        self.config['output'] = option[1]
+                    elif option[0] == 'store':
+                        self.config['store'] = option[1]
+                    elif option[0] == 'rate_limit':
+                        self.config['rate_limit'] = float(option[1])
+                    elif option[0] == 'bandwidth_limit':
+                        self.config['bandwidth_limit'] = float(option[1])
+                    elif option[0] == 'progress':
+                        self.config['progress'] = option[1] == '1'
+                    elif option[0] == 'metrics_file':
+                        self.config['metrics_file'] = option[1]
+                    elif option[0] == 'metrics_format':
+                        self.config['metrics_format'] = option[1]
+                    elif option[0] == 'comic_max_workers':
+                        self.config['comic_max_workers'] = int(option[1])
+                    elif option[0] == 'packed_images':
+                        self.config['packed_images'] = option[1] == '1'
+                    elif option[0] == 'daemon_port':
+                        self.config['daemon_port'] = int(option[1])
+                    elif option[0] == 'daemon_roots':
+                        self.config['daemon_roots'] = [root for root in option[1].split(os.pathsep) if root]
+                    elif option[0] == 'autotune':
+                        self.config['autotune'] = option[1] == '1'
+                    elif option[0] == 'autotune_interval':
+                        self.config['autotune_interval'] = float(option[1])
+                    elif option[0] == 'json_backend':
+                        self.config['json_backend'] = option[1]
         except Exception:
             print(traceback.format_exc())
+        if config:
+            self.config.update(config)
+
+        if self.config['http2']:
+            try:
+                import h2
+            except ImportError:
+                print('未安裝h2，不使用HTTP/2')
+                self.config['http2'] = False
+        self.json_loads = json.loads
+        if self.config['json_backend'] not in ('auto', 'json', 'orjson'):
+            print(f'json_backend必須為auto、json或orjson：{self.config["json_backend"]}')
+            sys.exit(1)
+        if self.config['json_backend'] != 'json':
+            try:
+                import orjson
+                self.json_loads = orjson.loads
+                self.config['json_backend'] = 'orjson'
+            except ImportError:
+                if self.config['json_backend'] == 'orjson':
+                    print('json_backend設為orjson，但未安裝orjson')
+                    sys.exit(1)
+                self.config['json_backend'] = 'json'
+
+        # Bound number of images waiting for or in decrypt_pool
+        self.decrypt_slots = threading.BoundedSemaphore(max(1, self.config['decrypt_processes'] * 2))
+        self.store = PageStore(Path(self.config['store'])) if self.config['store'] else None
+        self.metrics = Metrics(self.config['metrics_file'], self.config['metrics_format'], self.config['progress'])
+        self.rate_limiter = RateLimiter(self.config['rate_limit'], self.config['bandwidth_limit'])
+        self.retry_policy = RetryPolicy(self.config['retry_backoff'], self.config['retry_backoff_max'],
+                                        self.config['retry_statuses'], self.config['retry_budget'])
+        # Separate connection pools, so image downloads do not starve API requests
+        self.client = self.make_client()
+        self.image_client = self.make_client()
+        self.engine = None
+        if self.config['engine'] == 'async':
+            self.engine = AsyncEngine(self.make_client(True), self.make_client(True), self.config['async_concurrency'], self.config['threads'])
+        self.tuner = None
+        if self.config['autotune']:
+            self.tuner = ConcurrencyTuner(self.metrics, self.set_concurrency, self.max_concurrency,
+                                          self.config['autotune_interval'])
+            self.set_concurrency(round(self.tuner.limit))
+
+    def make_client(self, asynchronous=False):
+        """Create HTTP client with connection pool settings from config
+
+        :param asynchronous: Create httpx.AsyncClient instead of httpx.Client
+        :type asynchronous: bool
+        :rtype: httpx.Client | httpx.AsyncClient
+        """
+        max_keepalive_connections = self.config['max_keepalive_connections']
+        if max_keepalive_connections <= 0:
+            concurrency = self.config['async_concurrency'] if self.config['engine'] == 'async' else self.config['threads']
+            max_keepalive_connections = max(20, concurrency)
+        limits = httpx.Limits(max_connections=self.config['max_connections'],
+                              max_keepalive_connections=max_keepalive_connections,
+                              keepalive_expiry=self.config['keepalive_expiry'])
+        if asynchronous:
+            return httpx.AsyncClient(http2=self.config['http2'], limits=limits)
+        return httpx.Client(http2=self.config['http2'], limits=limits)
+
+    def max_concurrency(self):
+        """Upper bound of concurrent image downloads, from current config
+
+        :rtype: int
+        """
+        return self.config['async_concurrency'] if self.engine else self.config['threads']
+
+    def set_concurrency(self, limit):
+        """Change number of image downloads allowed to run at once
+
+        :type limit: int
+        """
+        if self.engine:
+            self.engine.set_limit(limit)
+        elif isinstance(ExtractorBase.pool, FairExecutor):
+            ExtractorBase.pool.set_limit(limit)
 
     def main(self):
         signal.signal(signal.SIGINT, self.interrupt)
-        self.arg_parse()
+        try:
+            self.arg_parse()
+        finally:
+            if self.tuner:
+                self.tuner.close()
+            self.metrics.close()
 
     def interrupt(self, sig, frame):
         if not multiprocessing.parent_process():
@@ -91,6 +342,16 @@ class ExtractorNoChapterBase(ABC):
             text += f'{sys.argv[0]} search QUERY\n    搜索漫畫。QUERY為關鍵字\n'
         text += f'''{sys.argv[0]} dl [-o 下載位置] COMIC_ID ...
     下載漫畫。COMIC_ID為漫畫的ID。可指定多個COMIC_ID
+{sys.argv[0]} gc-store
+    刪除圖片庫中未被任何章節使用的圖片
+{sys.argv[0]} serve
+    常駐模式，保持連線與快取，依序執行submit送出的工作
+{sys.argv[0]} submit 指令 ...
+    將指令（如dl-all [-o 下載位置] COMIC_ID）送到常駐程式執行，不等待完成
+{sys.argv[0]} jobs [JOB_ID]
+    列出常駐程式的工作，或顯示工作的狀態與輸出
+{sys.argv[0]} cancel JOB_ID
+    取消常駐程式的工作
 '''
         return text
 
@@ -172,6 +433,22 @@ class ExtractorNoChapterBase(ABC):
                 except Exception as e:
                     print(traceback.format_exc())
                     print(f'章節 {comic_id} 下載失敗：{e}')
+        elif sys.argv[1] == 'gc-store':
+            self.gc_store()
+        elif sys.argv[1] == 'serve':
+            self.serve()
+        elif sys.argv[1] == 'submit':
+            if len(sys.argv) < 3:
+                self.show_help()
+                sys.exit(0)
+            self.submit_job(sys.argv[2:])
+        elif sys.argv[1] == 'jobs':
+            self.show_jobs(sys.argv[2] if len(sys.argv) > 2 else None)
+        elif sys.argv[1] == 'cancel':
+            if len(sys.argv) != 3:
+                self.show_help()
+                sys.exit(0)
+            self.cancel_job(sys.argv[2])
         else:
             self.show_help()
 
@@ -190,40 +467,619 @@ class ExtractorNoChapterBase(ABC):
         """
         return encrypted
 
-    def get_request(self, url, headers=None, cookies=None):
-        """Wrapper of httpx.get() to retry failed request"""
+    def sleep(self, seconds):
+        """Sleep, but return early when interrupted"""
+        end = time.monotonic() + seconds
+        while not self.is_interrupted and time.monotonic() < end:
+            time.sleep(min(0.1, end - time.monotonic()))
+
+    def retry_call(self, attempt):
+        """Call attempt() until it succeeds, retrying exceptions and responses
+        with status in retry_statuses, waiting as decided by retry policy
+
+        :param attempt: Function sending request
+        :type attempt: Callable[[], httpx.Response]
+        :return: Last response
+        :rtype: httpx.Response
+        """
         for i in range(self.config['retries']):
-            if self.is_interrupted:
-                raise Exception('被中斷')
+            self.sleep(self.before_attempt(i))
             try:
-                return self.client.get(url, headers=headers, cookies=cookies)
+                response = attempt()
             except Exception as e:
-                if i == self.config['retries'] - 1:
-                    raise e
-
-    def post_request(self, url, data=None, json=None, headers=None, cookies=None):
-        """Wrapper of httpx.post() to retry failed request"""
+                self.sleep(self.delay_after_exception(i, e))
+                continue
+            self.sleep(self.account_response(response))
+            delay = self.delay_after_response(i, response)
+            if delay is None:
+                return response
+            # Responses of async engine are already read, and cannot be closed synchronously
+            if not response.is_closed:
+                response.close()
+            self.sleep(delay)
+
+    async def retry_call_async(self, attempt):
+        """retry_call() for async engine
+
+        :param attempt: Function returning coroutine which sends request
+        :type attempt: Callable[[], Awaitable[httpx.Response]]
+        :return: Last response
+        :rtype: httpx.Response
+        """
         for i in range(self.config['retries']):
-            if self.is_interrupted:
-                raise Exception('被中斷')
+            await asyncio.sleep(self.before_attempt(i))
             try:
-                return self.client.post(url, data=data, json=json, headers=headers, cookies=cookies)
+                response = await attempt()
             except Exception as e:
-                if i == self.config['retries'] - 1:
-                    raise e
+                await asyncio.sleep(self.delay_after_exception(i, e))
+                continue
+            await asyncio.sleep(self.account_response(response))
+            delay = self.delay_after_response(i, response)
+            if delay is None:
+                return response
+            await response.aclose()
+            await asyncio.sleep(delay)
+
+    def before_attempt(self, i):
+        """Start attempt i of retry_call(), raise if interrupted
+
+        :param i: number of previous attempts
+        :type i: int
+        :return: Seconds to wait for rate limit before sending request
+        :rtype: float
+        """
+        if self.is_interrupted:
+            raise Exception('被中斷')
+        if i > 0:
+            self.metrics.retry()
+        return self.rate_limiter.reserve_request()
+
+    def delay_after_exception(self, i, e):
+        """Decide retry after attempt i raised e, which is raised again if not retried
+
+        :return: Seconds to wait before next attempt
+        :rtype: float
+        """
+        if i == self.config['retries'] - 1:
+            raise e
+        self.retry_policy.record_failure()
+        if not self.retry_policy.can_retry():
+            raise e
+        return self.retry_policy.delay(i)
+
+    def account_response(self, response):
+        """Record response in rate limiter and metrics
+
+        :type response: httpx.Response
+        :return: Seconds to wait for bandwidth limit
+        :rtype: float
+        """
+        self.rate_limiter.record(response)
+        self.metrics.received(response.num_bytes_downloaded)
+        return self.rate_limiter.reserve_bytes(response.num_bytes_downloaded)
+
+    def delay_after_response(self, i, response):
+        """Decide retry after attempt i got response
+
+        :type response: httpx.Response
+        :return: Seconds to wait before next attempt, or None to return response
+        :rtype: float | None
+        """
+        if not self.retry_policy.should_retry(response):
+            self.retry_policy.record_success()
+            return None
+        if i == self.config['retries'] - 1:
+            return None
+        self.retry_policy.record_failure()
+        if not self.retry_policy.can_retry():
+            return None
+        return self.retry_policy.delay(i, response)
+
+    def get_request(self, url, headers=None, cookies=None):
+        """Wrapper of httpx.get() to retry failed request"""
+        if self.engine:
+            return self.retry_call(lambda: self.engine.call(self.engine.client.get(url, headers=headers, cookies=cookies)))
+        return self.retry_call(lambda: self.client.get(url, headers=headers, cookies=cookies))
+
+    def post_request(self, url, data=None, json=None, headers=None, cookies=None, content=None):
+        """Wrapper of httpx.post() to retry failed request"""
+        if self.engine:
+            return self.retry_call(lambda: self.engine.call(self.engine.client.post(url, content=content, data=data, json=json, headers=headers, cookies=cookies)))
+        return self.retry_call(lambda: self.client.post(url, content=content, data=data, json=json, headers=headers, cookies=cookies))
 
     def send_request(self, request):
-        """Wrapper of httpx.Client.send() to retry failed request"""
-        for i in range(self.config['retries']):
-            if self.is_interrupted:
-                raise Exception('被中斷')
+        """Wrapper of httpx.Client.send() to retry failed request, sent with image client"""
+        if self.engine:
+            return self.retry_call(lambda: self.engine.call(self.engine.image_client.send(request)))
+        return self.retry_call(lambda: self.image_client.send(request))
+
+    async def send_request_async(self, request):
+        """Wrapper of httpx.AsyncClient.send() to retry failed request, sent with image client"""
+        return await self.retry_call_async(lambda: self.engine.image_client.send(request))
+
+    def get_image_filename(self, idx, image_request, path):
+        """Get filename of downloaded image
+
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_request: request of image
+        :type image_request: httpx.Request
+        :param path: Download location
+        :type path: Path
+        :return: filename of image
+        :rtype: Path
+        """
+        if self.image_extension:
+            ext = self.image_extension
+        else:
+            ext = Path(image_request.url.path).suffix
+            # Fix Kuaikan and Kakao extension
+            if ext == '.h' or ext == '.cef':
+                ext = Path(Path(image_request.url.path).stem).suffix
+            if not ext:
+                ext = '.jpg'
+        return Path(path, str(idx).zfill(3) + ext)
+
+    def save_image(self, content, idx, image_request, filename, decrypt_info):
+        """Decrypt downloaded image and write it to file
+
+        :param content: downloaded image content
+        :type content: bytes
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_request: request of image
+        :type image_request: httpx.Request
+        :param filename: filename of image
+        :type filename: Path
+        :param decrypt_info: Information for image decryption
+        """
+        with self.metrics.timing('decrypt'):
+            if self.config['decrypt_processes'] > 0:
+                content = self.decrypt_in_process(content, idx, image_request.url, decrypt_info)
+            else:
+                content = self.decrypt_image(content, idx, image_request.url, decrypt_info)
+        self.write_file(filename, [content])
+
+    def decrypt_in_process(self, encrypted, idx, image_url, decrypt_info):
+        """Run decrypt_image() in decrypt_pool, so CPU-bound decryption is not
+        serialized by the GIL. Blocks while too many images are queued for decryption
+
+        :param encrypted: encrypted image content
+        :type encrypted: bytes
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_url: url of image
+        :type image_url: httpx.URL
+        :param decrypt_info: Information for image decryption
+        :return: decrypted image
+        :rtype: bytes
+        """
+        with self.decrypt_slots:
+            with self.lock:
+                if not ExtractorNoChapterBase.decrypt_pool:
+                    ExtractorNoChapterBase.decrypt_pool = ProcessPoolExecutor(max_workers=self.config['decrypt_processes'])
+            state = {key: getattr(self, key) for key in self.decrypt_attributes}
+            future = ExtractorNoChapterBase.decrypt_pool.submit(ExtractorNoChapterBase.decrypt_in_worker, type(self), state,
+                                                                encrypted, idx, image_url, decrypt_info)
+            return future.result()
+
+    @staticmethod
+    def decrypt_in_worker(cls, state, encrypted, idx, image_url, decrypt_info):
+        """Run decrypt_image() in decrypt_pool process, on extractor of class cls
+        with only the attributes in state, without calling __init__()
+
+        :param cls: class of extractor
+        :type cls: type[ExtractorNoChapterBase]
+        :param state: attributes listed in decrypt_attributes
+        :type state: dict
+        :return: decrypted image
+        :rtype: bytes
+        """
+        extractor = cls.__new__(cls)
+        extractor.__dict__.update(state)
+        return extractor.decrypt_image(encrypted, idx, image_url, decrypt_info)
+
+    def image_needs_buffer(self):
+        """Whether images have to be downloaded into memory for decrypt_image()
+
+        :rtype: bool
+        """
+        if self.decrypt_needs_buffer is None:
+            return type(self).decrypt_image is not ExtractorNoChapterBase.decrypt_image
+        return self.decrypt_needs_buffer
+
+    def create_output(self, path):
+        """Create output of chapter according to output option
+
+        :param path: Download location
+        :type path: Path
+        :rtype: DirectoryOutput | CbzOutput
+        """
+        if self.config['output'] == 'cbz':
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return CbzOutput(path)
+        path.mkdir(parents=True, exist_ok=True)
+        return DirectoryOutput(path)
+
+    def get_output(self, path):
+        """Get output of chapter being downloaded to path. Images downloaded
+        outside of submit_list() are written to directory
+
+        :param path: Download location
+        :type path: Path
+        :rtype: DirectoryOutput | CbzOutput
+        """
+        return self.outputs.get(path) or DirectoryOutput(path)
+
+    def open_temp_file(self, filename):
+        """Open temporary file to be committed to filename by commit_temp_file()
+
+        :param filename: filename of image
+        :type filename: Path
+        :return: opened temporary file
+        :rtype: BinaryIO
+        """
+        return self.get_output(filename.parent).open(filename)
+
+    def commit_temp_file(self, f, filename):
+        """Commit temporary file to output, so it appears complete or not at all
+
+        :param f: file returned by open_temp_file()
+        :type f: BinaryIO
+        :param filename: filename of image
+        :type filename: Path
+        """
+        self.get_output(filename.parent).commit(f, filename)
+
+    def discard_temp_file(self, f, filename):
+        """Close and remove temporary file after failed write, so no .part file is left
+
+        :param f: file returned by open_temp_file()
+        :type f: BinaryIO
+        :param filename: filename of image
+        :type filename: Path
+        """
+        self.get_output(filename.parent).discard(f)
+
+    def write_file(self, filename, chunks):
+        """Write chunks to file atomically, so interrupted write does not leave truncated file
+
+        :param filename: filename of image
+        :type filename: Path
+        :param chunks: content of file
+        :type chunks: Iterable[bytes]
+        """
+        with self.metrics.timing('write'):
+            f = self.open_temp_file(filename)
+        try:
+            for chunk in chunks:
+                with self.metrics.timing('write'):
+                    f.write(chunk)
+            with self.metrics.timing('write'):
+                self.commit_temp_file(f, filename)
+        except:
+            self.discard_temp_file(f, filename)
+            raise
+
+    def fetch_image(self, idx, image_request, filename, decrypt_info):
+        """Download image to filename, retrying failed requests
+
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_request: request of image
+        :type image_request: httpx.Request
+        :param filename: filename of image
+        :type filename: Path
+        :param decrypt_info: Information for image decryption
+        :return: Closed response, image is saved only if it is successful
+        :rtype: httpx.Response
+        """
+        if self.image_needs_buffer():
+            r = self.send_request(image_request)
+            if r.is_success:
+                self.save_image(r.content, idx, image_request, filename, decrypt_info)
+        else:
+            r = self.retry_call(lambda: self.stream_image(image_request, filename))
+            r.close()
+        return r
+
+    async def fetch_image_async(self, idx, image_request, filename, decrypt_info):
+        """fetch_image() for async engine, decryption runs in executor"""
+        if self.image_needs_buffer():
+            r = await self.send_request_async(image_request)
+            if r.is_success:
+                await self.engine.run_in_executor(self.save_image, r.content, idx, image_request, filename, decrypt_info)
+        else:
+            r = await self.retry_call_async(lambda: self.stream_image_async(image_request, filename))
+            await r.aclose()
+        return r
+
+    def refresh_image_request(self, image_download, idx, image_request, path):
+        """Rebuild image requests of chapter after auth of image_request expired,
+        e.g. pageImageToken of a chapter queued for long. Workers of the same chapter
+        wait for one refresh, and each chapter is refreshed at most once
+
+        :param image_download: ImageDownload object of image
+        :type image_download: ImageDownload | None
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_request: request of image which got auth error
+        :type image_request: httpx.Request
+        :param path: Download location
+        :type path: Path
+        :return: New request of image, or None if it cannot be refreshed
+        :rtype: httpx.Request | None
+        """
+        if image_download is None or image_download.refresh is None:
+            return None
+        with image_download.refresh_lock:
+            current = image_download.requests[idx - 1]
+            if current is not image_request:
+                # Refreshed by another worker
+                return current
+            if image_download.refreshed:
+                return None
+            image_download.refreshed = True
+            print(f'{path} 圖片認證過期，重新取得圖片列表')
             try:
-                return self.client.send(request)
+                refreshed = image_download.refresh()
             except Exception as e:
-                if i == self.config['retries'] - 1:
-                    raise e
+                print(f'{path} 重新取得圖片列表失敗：{e}')
+                return None
+            if len(refreshed.requests) != len(image_download.requests):
+                print(f'{path} 圖片數量改變，無法更新圖片列表')
+                return None
+            image_download.requests[:] = refreshed.requests
+            image_download.packed_request = refreshed.packed_request
+            return image_download.requests[idx - 1]
+
+    def stream_image(self, image_request, filename):
+        """Send image request, and write response to filename if it is successful
+
+        :param image_request: request of image
+        :type image_request: httpx.Request
+        :param filename: filename of image
+        :type filename: Path
+        :return: Response, body is already consumed if successful
+        :rtype: httpx.Response
+        """
+        r = self.image_client.send(image_request, stream=True)
+        if r.is_success:
+            try:
+                self.write_file(filename, r.iter_bytes())
+            finally:
+                r.close()
+        return r
+
+    async def stream_image_async(self, image_request, filename):
+        """stream_image() for async engine, file writing runs in executor"""
+        r = await self.engine.image_client.send(image_request, stream=True)
+        if r.is_success:
+            try:
+                with self.metrics.timing('write'):
+                    f = await self.engine.run_in_executor(self.open_temp_file, filename)
+                try:
+                    async for chunk in r.aiter_bytes():
+                        with self.metrics.timing('write'):
+                            await self.engine.run_in_executor(f.write, chunk)
+                    with self.metrics.timing('write'):
+                        await self.engine.run_in_executor(self.commit_temp_file, f, filename)
+                except:
+                    await self.engine.run_in_executor(self.discard_temp_file, f, filename)
+                    raise
+            finally:
+                await r.aclose()
+        return r
+
+    def page_downloaded(self, image_download, idx, filename):
+        """Whether image is already downloaded, according to manifest if available
+
+        :param image_download: ImageDownload object of image
+        :type image_download: ImageDownload | None
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: bool
+        """
+        size = self.get_output(filename.parent).size(filename)
+        manifest = image_download and image_download.manifest
+        if not manifest:
+            return size is not None
+        page = manifest.get_page(image_download.chapter_key, idx)
+        if page is None:
+            # Downloaded before manifest was used
+            if size is not None:
+                self.record_page(image_download, idx, filename)
+                return True
+            return False
+        return filename.name == page[0] and size == page[1]
+
+    def record_page(self, image_download, idx, filename):
+        """Record size and checksum of downloaded image in manifest
+
+        :param image_download: ImageDownload object of image
+        :type image_download: ImageDownload | None
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param filename: filename of image
+        :type filename: Path
+        """
+        manifest = image_download and image_download.manifest
+        if not manifest:
+            return
+        size, checksum = self.get_output(filename.parent).checksum(filename)
+        manifest.record_page(image_download.chapter_key, idx, filename.name, size, checksum)
+
+    def materialize_page(self, image_url, filename, downloaded=None):
+        """Put image in store into output of chapter. Image just downloaded is added to store first
+
+        :param image_url: url of image
+        :type image_url: httpx.URL
+        :param filename: filename of image
+        :type filename: Path
+        :param downloaded: filename of downloaded image in temporary directory of store
+        :type downloaded: Path | None
+        :return: Whether image is in store
+        :rtype: bool
+        """
+        if downloaded:
+            source = self.store.add(image_url, downloaded)
+        else:
+            source = self.store.get(image_url)
+            if source is None:
+                return False
+        try:
+            self.get_output(filename.parent).link(source, filename)
+        except FileNotFoundError:
+            # Removed by gc-store
+            return False
+        return True
+
+    def serve(self):
+        """Daemon mode. Keep extractor with its connections, download pool and caches,
+        and run jobs submitted to local HTTP API one by one"""
+        jobs = JobQueue(self.cancel_running_job, self.config['daemon_roots'] or [os.getcwd()])
+        server = ThreadingHTTPServer(('127.0.0.1', self.config['daemon_port']), JobRequestHandler)
+        server.daemon_threads = True
+        server.jobs = jobs
+        server.token = secrets.token_hex(32)
+        # Only user running daemon can read token
+        token_file = self.daemon_token_file()
+        token_file.unlink(missing_ok=True)
+        with os.fdopen(os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            f.write(server.token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'常駐模式，於 http://127.0.0.1:{self.config["daemon_port"]} 接收工作', flush=True)
+        try:
+            while not self.is_interrupted:
+                try:
+                    job = jobs.queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self.run_job(jobs, job)
+        finally:
+            server.shutdown()
+            server.server_close()
+            token_file.unlink(missing_ok=True)
+
+    def daemon_token_file(self):
+        """File of secret token required by local job API of daemon
+
+        :rtype: Path
+        """
+        return Path(__file__).parent / f'{self.name}-daemon-token'
+
+    def cancel_running_job(self):
+        self.is_interrupted = True
+
+    def run_job(self, jobs, job):
+        """Run job with its arguments and working directory, output is kept in job
+
+        :param jobs: JobQueue of job
+        :type jobs: JobQueue
+        :param job: job to run
+        :type job: dict
+        """
+        with jobs.lock:
+            if job['status'] != 'queued':
+                return
+            job['status'] = 'running'
+            job['started'] = time.time()
+        argv = sys.argv
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        status = 'done'
+        try:
+            sys.argv = [argv[0]] + job['args']
+            os.chdir(job['cwd'])
+            sys.stdout = JobOutput(job, stdout)
+            self.arg_parse()
+        except SystemExit:
+            # Help is shown for invalid arguments
+            status = 'failed'
+            job['error'] = '參數錯誤'
+        except Exception as e:
+            print(traceback.format_exc())
+            status = 'failed'
+            job['error'] = str(e)
+        finally:
+            sys.stdout = stdout
+            sys.argv = argv
+            os.chdir(cwd)
+        with jobs.lock:
+            if job['status'] == 'cancelling':
+                status = 'cancelled'
+                self.is_interrupted = False
+            job['status'] = status
+            job['finished'] = time.time()
+        print(f'工作 {job["id"]} {status}：{" ".join(job["args"])}', flush=True)
+
+    def daemon_request(self, method, path, json=None):
+        """Send request to local job API of daemon
+
+        :rtype: dict | list
+        """
+        try:
+            token = self.daemon_token_file().read_text().strip()
+        except OSError:
+            print('無法讀取常駐程式的token，請先執行serve')
+            sys.exit(1)
+        try:
+            r = httpx.request(method, f'http://127.0.0.1:{self.config["daemon_port"]}{path}', json=json,
+                              headers={'Authorization': f'Bearer {token}'})
+        except httpx.ConnectError:
+            print('無法連線到常駐程式，請先執行serve')
+            sys.exit(1)
+        j = r.json()
+        if r.is_error:
+            print(j['error'])
+            sys.exit(1)
+        return j
+
+    def submit_job(self, args):
+        """Queue job in daemon and return without waiting for it
+
+        :param args: command line arguments of job
+        :type args: list[str]
+        """
+        job = self.daemon_request('POST', '/jobs', {'args': args, 'cwd': os.getcwd()})
+        print(f'已送出工作 {job["id"]}')
+
+    def show_jobs(self, job_id=None):
+        """Show jobs of daemon, or status and output of one job
+
+        :param job_id: id of job
+        :type job_id: str | None
+        """
+        if job_id is None:
+            for job in self.daemon_request('GET', '/jobs'):
+                print(f'{job["id"]}\t{job["status"]}\t{" ".join(job["args"])}')
+            return
+        job = self.daemon_request('GET', f'/jobs/{job_id}')
+        print(f'{job["id"]}\t{job["status"]}\t{" ".join(job["args"])}')
+        if job['error']:
+            print(job['error'])
+        print(job['output'], end='')
 
-    def download_img(self, idx, image_request, path, decrypt_info):
+    def cancel_job(self, job_id):
+        """Cancel queued or running job of daemon
+
+        :param job_id: id of job
+        :type job_id: str
+        """
+        job = self.daemon_request('DELETE', f'/jobs/{job_id}')
+        print(f'工作 {job["id"]} {job["status"]}')
+
+    def gc_store(self):
+        """Remove images in store which are not recorded in manifest of any existing chapter"""
+        if not self.store:
+            print('未設定圖片庫（store）')
+            return
+        count, size = self.store.gc()
+        print(f'已刪除{count}個檔案，共{size / (1 << 20):.1f} MiB')
+
+    def download_img(self, idx, image_request, path, decrypt_info, image_download=None):
         """Called by download_worker to download image
 
         :param idx: index (page number) of image, starts from 1
@@ -233,30 +1089,115 @@ class ExtractorNoChapterBase(ABC):
         :param path: Download location
         :type path: Path
         :param decrypt_info: Information for image decryption
+        :param image_download: ImageDownload object of image, for recording in manifest
+        :type image_download: ImageDownload | None
+        :return: Whether image is downloaded
+        :rtype: bool
         """
+        page = self.metrics.start_page()
+        status = 'failed'
         try:
             if self.is_interrupted:
-                return
-            if self.image_extension:
-                ext = self.image_extension
-            else:
-                ext = Path(image_request.url.path).suffix
-                # Fix Kuaikan and Kakao extension
-                if ext == '.h' or ext == '.cef':
-                    ext = Path(Path(image_request.url.path).stem).suffix
-                if not ext:
-                    ext = '.jpg'
-            filename = Path(path, str(idx).zfill(3) + ext)
-            if filename.exists():
-                return
-
-            r = self.send_request(image_request)
-            content = self.decrypt_image(r.content, idx, image_request.url, decrypt_info)
-            with filename.open('wb') as f:
-                f.write(content)
+                status = 'cancelled'
+                return False
+            filename = self.get_image_filename(idx, image_request, path)
+            reused = self.reuse_page(image_download, idx, image_request, filename)
+            if reused:
+                status = reused
+                return True
+            image_request, target = self.page_download_target(image_download, idx, image_request, filename)
+            r = self.fetch_image(idx, image_request, target, decrypt_info)
+            if r.status_code in RetryPolicy.auth_statuses:
+                refreshed_request = self.refresh_image_request(image_download, idx, image_request, path)
+                if refreshed_request:
+                    image_request = refreshed_request
+                    r = self.fetch_image(idx, image_request, target, decrypt_info)
+            r.raise_for_status()
+            self.keep_downloaded_page(image_download, idx, image_request, filename, target)
+            status = 'downloaded'
+            return True
         except Exception as e:
-            print(traceback.format_exc())
-            print(path / str(idx).zfill(3), '下載失敗：', e)
+            self.print_page_error(path, idx, e)
+            return False
+        finally:
+            self.metrics.finish_page(page, path, idx, status)
+
+    async def download_img_async(self, idx, image_request, path, decrypt_info, image_download=None):
+        """download_img() for async engine. Decryption and file writing run in executor"""
+        run_in_executor = self.engine.run_in_executor
+        async with self.engine.slot():
+            page = self.metrics.start_page()
+            status = 'failed'
+            try:
+                if self.is_interrupted:
+                    status = 'cancelled'
+                    return False
+                filename = self.get_image_filename(idx, image_request, path)
+                reused = await run_in_executor(self.reuse_page, image_download, idx, image_request, filename)
+                if reused:
+                    status = reused
+                    return True
+                image_request, target = self.page_download_target(image_download, idx, image_request, filename)
+                r = await self.fetch_image_async(idx, image_request, target, decrypt_info)
+                if r.status_code in RetryPolicy.auth_statuses:
+                    refreshed_request = await run_in_executor(self.refresh_image_request, image_download, idx, image_request, path)
+                    if refreshed_request:
+                        image_request = refreshed_request
+                        r = await self.fetch_image_async(idx, image_request, target, decrypt_info)
+                r.raise_for_status()
+                await run_in_executor(self.keep_downloaded_page, image_download, idx, image_request, filename, target)
+                status = 'downloaded'
+                return True
+            except Exception as e:
+                self.print_page_error(path, idx, e)
+                return False
+            finally:
+                self.metrics.finish_page(page, path, idx, status)
+
+    def reuse_page(self, image_download, idx, image_request, filename):
+        """Keep image already downloaded, or put image in store into output
+
+        :param image_download: ImageDownload object of image
+        :type image_download: ImageDownload | None
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param image_request: request of image
+        :type image_request: httpx.Request
+        :param filename: filename of image
+        :type filename: Path
+        :return: skipped or stored, or None if image needs to be downloaded
+        :rtype: str | None
+        """
+        if self.page_downloaded(image_download, idx, filename):
+            self.get_output(filename.parent).keep(filename)
+            return 'skipped'
+        if self.store and self.materialize_page(image_request.url, filename):
+            self.record_page(image_download, idx, filename)
+            return 'stored'
+        return None
+
+    def page_download_target(self, image_download, idx, image_request, filename):
+        """Request to send and file to download image to
+
+        :return: Request of image, and temporary file of store or filename
+        :rtype: tuple[httpx.Request, Path]
+        """
+        if image_download and image_download.refreshed:
+            # Requests of chapter were rebuilt with new auth after this page was queued
+            image_request = image_download.requests[idx - 1]
+        target = self.store.temp_filename(filename) if self.store else filename
+        return image_request, target
+
+    def keep_downloaded_page(self, image_download, idx, image_request, filename, target):
+        """Move downloaded image from target into store and output, and record it in manifest"""
+        if self.store:
+            self.materialize_page(image_request.url, filename, target)
+        self.record_page(image_download, idx, filename)
+
+    def print_page_error(self, path, idx, e):
+        """Print traceback of failed page, called in except block"""
+        print(traceback.format_exc())
+        print(path / str(idx).zfill(3), '下載失敗：', e)
 
     def download_list(self, image_download):
         """Download images
@@ -264,8 +1205,18 @@ class ExtractorNoChapterBase(ABC):
         :param image_download: ImageDownload object
         :type image_download: ImageDownload
         """
+        wait(self.submit_list(image_download))
+
+    def submit_list(self, image_download):
+        """Submit images to download pool without waiting for them
+
+        :param image_download: ImageDownload object
+        :type image_download: ImageDownload
+        :return: Futures of image downloads
+        :rtype: list[concurrent.futures.Future]
+        """
         if self.is_interrupted:
-            return
+            return []
         root = image_download.root
         comic_title = self.fix_filename(image_download.comic_title)
         if image_download.chapter_title:
@@ -275,11 +1226,208 @@ class ExtractorNoChapterBase(ABC):
         else:
             print(f'下載{comic_title}')
             path = Path(root, comic_title)
-        path.mkdir(parents=True, exist_ok=True)
-        if not ExtractorBase.pool:
-            ExtractorBase.pool = self.Executor(max_workers=self.config['threads'])
-        futures = [ExtractorBase.pool.submit(self.download_img, idx + 1, url, path, image_download.decrypt_info) for idx, url in enumerate(image_download.requests)]
-        wait(futures)
+        start = time.perf_counter()
+        output = self.create_output(path)
+        self.outputs[path] = output
+        self.metrics.queue_pages(len(image_download.requests))
+        if image_download.chapter_key and self.config['manifest']:
+            image_download.manifest = self.get_manifest(root)
+            image_download.manifest.start_chapter(image_download.chapter_key, output.location, len(image_download.requests))
+        if self.engine:
+            submit = self.engine.executor.submit
+
+            def submit_image(idx, url):
+                return self.engine.run(self.download_img_async(idx + 1, url, path, image_download.decrypt_info, image_download))
+        else:
+            if not ExtractorBase.pool:
+                ExtractorBase.pool = self.Executor(max_workers=self.config['threads'])
+                if isinstance(ExtractorBase.pool, FairExecutor):
+                    ExtractorBase.pool.max_workers_per_key = self.config['comic_max_workers']
+                    if self.tuner:
+                        ExtractorBase.pool.set_limit(round(self.tuner.limit))
+            submit = ExtractorBase.pool.submit
+            if isinstance(ExtractorBase.pool, FairExecutor):
+                # Comics take turns in download pool
+                submit = functools.partial(ExtractorBase.pool.submit_keyed, image_download.comic_title)
+
+            def submit_image(idx, url):
+                return submit(self.download_img, idx + 1, url, path, image_download.decrypt_info, image_download)
+        if image_download.packed_request:
+            futures = self.submit_packed(image_download, path, submit, submit_image)
+        else:
+            futures = [submit_image(idx, url) for idx, url in enumerate(image_download.requests)]
+        return futures + [self.finish_chapter_when_done(image_download, path, futures, start)]
+
+    def submit_packed(self, image_download, path, submit, submit_image):
+        """Submit download of packed images, images not written from it are submitted
+        one by one after it finishes
+
+        :param image_download: ImageDownload object with packed_request
+        :type image_download: ImageDownload
+        :param path: Download location
+        :type path: Path
+        :param submit: Function submitting task to download pool
+        :type submit: Callable[..., concurrent.futures.Future]
+        :param submit_image: Function submitting download of image with index and request
+        :type submit_image: Callable[[int, httpx.Request], concurrent.futures.Future]
+        :return: Futures of images
+        :rtype: list[concurrent.futures.Future]
+        """
+        futures = [Future() for _ in image_download.requests]
+
+        def chain(image_future, future):
+            image_future.add_done_callback(lambda f: future.set_result(not f.cancelled() and not f.exception() and f.result()))
+
+        def fallback(packed_future):
+            try:
+                written = packed_future.result()
+            except Exception:
+                written = set()
+            for idx, (url, future) in enumerate(zip(image_download.requests, futures)):
+                if idx + 1 in written:
+                    future.set_result(True)
+                else:
+                    chain(submit_image(idx, url), future)
+
+        submit(self.download_packed, image_download, path).add_done_callback(fallback)
+        return futures
+
+    def download_packed(self, image_download, path):
+        """Download packed images in one request, and write images in it. Packed
+        images are expected to be a ZIP archive of images, which sorted by name
+        are in page order. Not used if more than half of images are downloaded
+
+        :param image_download: ImageDownload object with packed_request
+        :type image_download: ImageDownload
+        :param path: Download location
+        :type path: Path
+        :return: Indices of images written or already downloaded
+        :rtype: set[int]
+        """
+        written = set()
+        if self.is_interrupted:
+            return written
+        requests = image_download.requests
+        filenames = [self.get_image_filename(idx + 1, url, path) for idx, url in enumerate(requests)]
+        downloaded = {idx + 1 for idx, filename in enumerate(filenames) if self.page_downloaded(image_download, idx + 1, filename)}
+        if len(downloaded) * 2 >= len(requests):
+            return written
+        try:
+            with tempfile.TemporaryFile() as f:
+                def attempt():
+                    r = self.image_client.send(image_download.packed_request, stream=True)
+                    if r.is_success:
+                        try:
+                            f.seek(0)
+                            f.truncate()
+                            for chunk in r.iter_bytes():
+                                f.write(chunk)
+                        finally:
+                            r.close()
+                    return r
+
+                r = self.retry_call(attempt)
+                r.close()
+                r.raise_for_status()
+                f.seek(0)
+                if f.read(4) != b'PK\x03\x04':
+                    print(path, '打包圖片不是ZIP，改為逐頁下載')
+                    return written
+                with zipfile.ZipFile(f) as archive:
+                    # Natural order, so 10.jpg is after 9.jpg
+                    names = sorted((name for name in archive.namelist() if not name.endswith('/')),
+                                   key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)])
+                    if len(names) != len(requests):
+                        print(path, f'打包圖片有{len(names)}頁，應為{len(requests)}頁，改為逐頁下載')
+                        return written
+                    for idx, (name, url, filename) in enumerate(zip(names, requests, filenames), 1):
+                        if self.is_interrupted:
+                            return written
+                        page = self.metrics.start_page()
+                        # Queued again for downloading alone if writing fails
+                        status = None
+                        try:
+                            if idx in downloaded:
+                                self.get_output(path).keep(filename)
+                                status = 'skipped'
+                            else:
+                                self.save_image(archive.read(name), idx, url, filename, image_download.decrypt_info)
+                                self.record_page(image_download, idx, filename)
+                                status = 'downloaded'
+                            written.add(idx)
+                        finally:
+                            self.metrics.finish_page(page, path, idx, status)
+        except Exception as e:
+            print(traceback.format_exc())
+            print(path, '打包圖片下載失敗，改為逐頁下載：', e)
+        return written
+
+    def finish_chapter_when_done(self, image_download, path, futures, start):
+        """Close output of chapter after all images are downloaded, and mark
+        chapter complete in manifest if all of them are successful
+
+        :param image_download: ImageDownload object
+        :type image_download: ImageDownload
+        :param path: Download location
+        :type path: Path
+        :param futures: Futures of image downloads
+        :type futures: list[concurrent.futures.Future]
+        :param start: time.perf_counter() when chapter is submitted, for metrics
+        :type start: float
+        :return: Future of whether all images are downloaded, done after chapter is finished
+        :rtype: concurrent.futures.Future
+        """
+        finished = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finish():
+            try:
+                success = all(f.result() for f in futures)
+                self.outputs.pop(path).close()
+                if success and image_download.manifest:
+                    image_download.manifest.finish_chapter(image_download.chapter_key)
+                self.metrics.finish_chapter(path, len(futures), time.perf_counter() - start, success)
+                finished.set_result(success)
+            except Exception as e:
+                print(traceback.format_exc())
+                print(path, '下載失敗：', e)
+                finished.set_result(False)
+
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                # Callbacks of async engine run in event loop
+                if self.engine:
+                    self.engine.executor.submit(finish)
+                else:
+                    finish()
+
+        if not futures:
+            finish()
+        for future in futures:
+            future.add_done_callback(done)
+        return finished
+
+    def get_manifest(self, root):
+        """Get manifest of download root, opening it if needed
+
+        :param root: root directory of download location
+        :type root: str
+        :rtype: Manifest
+        """
+        # Relative root of jobs in daemon mode depends on working directory of job
+        root = Path(root).resolve()
+        with self.lock:
+            if root not in self.manifests:
+                Path(root).mkdir(parents=True, exist_ok=True)
+                self.manifests[root] = Manifest(Path(root, f'.{self.name}-manifest.sqlite3'))
+                if self.store:
+                    # gc-store keeps images recorded in manifests of all roots using store
+                    self.store.add_manifest(Path(root, f'.{self.name}-manifest.sqlite3'))
+            return self.manifests[root]
 
     def fix_filename(self, name):
         """Convert invalid filename to valid name
@@ -318,10 +1466,11 @@ class ExtractorNoChapterBase(ABC):
         pass
 
     def getBoughtComicList(self):
-        """Fetch bought comic list from website
+        """Fetch bought comic list from website, can be a generator yielding
+        comics as pages of the list are fetched
 
-        :return: List of comic
-        :rtype: list[Comic]
+        :return: Iterable of comic
+        :rtype: Iterable[Comic]
         """
         self.show_help()
         sys.exit(0)
@@ -329,7 +1478,7 @@ class ExtractorNoChapterBase(ABC):
     def showBoughtComicList(self):
         """Display bought comic list"""
         for comic in self.getBoughtComicList():
-            print(comic.comic_id, comic.title)
+            print(comic.comic_id, comic.title, flush=True)
 
     def draw_image(self, src, dest, sx, sy, width, height, dx, dy):
         """Draw rectangular region of src image to dest image
@@ -354,6 +1503,57 @@ class ExtractorNoChapterBase(ABC):
         crop = src.crop((sx, sy, sx + width, sy + height))
         dest.paste(crop, (dx, dy))
 
+    def draw_tiles(self, src, dest, tiles):
+        """Draw many rectangular regions of src image to dest image, like calling
+        draw_image() for each tile. NumPy arrays (height x width [x channels]) are
+        copied between array views without allocating anything per tile. PIL
+        images use draw_image(), as converting them to arrays and back costs more
+        than cropping tiles
+
+        :param src: Source image
+        :type src: PIL.Image.Image | numpy.ndarray
+        :param dest: Destination image
+        :type dest: PIL.Image.Image | numpy.ndarray
+        :param tiles: Tiles as (sx, sy, width, height, dx, dy), see draw_image()
+        :type tiles: Iterable[tuple[int, int, int, int, int, int]]
+        """
+        numpy = sys.modules.get('numpy')
+        if numpy and isinstance(src, numpy.ndarray):
+            for sx, sy, width, height, dx, dy in tiles:
+                dest[dy:dy + height, dx:dx + width] = src[sy:sy + height, sx:sx + width]
+        else:
+            for tile in tiles:
+                self.draw_image(src, dest, *tile)
+
+    def descramble_grid(self, src, columns, rows, permutation):
+        """Rearrange image divided into columns x rows tiles of equal size with
+        draw_tiles(). Tiles are numbered row by row, tile i of result is tile
+        permutation[i] of src. Pixels at right and bottom edges not covered by
+        tiles are kept
+
+        :param src: Scrambled image
+        :type src: PIL.Image.Image | numpy.ndarray
+        :param columns: Number of tile columns
+        :type columns: int
+        :param rows: Number of tile rows
+        :type rows: int
+        :param permutation: Source tile index of each tile
+        :type permutation: list[int]
+        :return: Descrambled image, of same type as src
+        :rtype: PIL.Image.Image | numpy.ndarray
+        """
+        numpy = sys.modules.get('numpy')
+        if numpy and isinstance(src, numpy.ndarray):
+            height, width = src.shape[:2]
+        else:
+            width, height = src.size
+        tile_width = width // columns
+        tile_height = height // rows
+        dest = src.copy()
+        self.draw_tiles(src, dest, [(j % columns * tile_width, j // columns * tile_height, tile_width, tile_height,
+                                     i % columns * tile_width, i // columns * tile_height) for i, j in enumerate(permutation)])
+        return dest
+
 class ExtractorBase(ExtractorNoChapterBase):
 
     def create_help(self, login, bought, search, removed):
@@ -387,6 +1587,18 @@ class ExtractorBase(ExtractorNoChapterBase):
     下載漫畫所有章節。COMIC_ID為漫畫的ID。可指定多個COMIC_ID
 {sys.argv[0]} dl-seq [-o 下載位置] COMIC_ID ... INDEX
     依照章節序號下載漫畫。COMIC_ID為漫畫的ID，可指定多個COMIC_ID。INDEX為章節在list-bought-chapter中的序號，序號前加r代表反序。可使用-代表範圍，用,下載不連續章節。
+{sys.argv[0]} sync [-o 下載位置] COMIC_ID ...
+    只下載新章節與新解鎖章節。COMIC_ID為漫畫的ID。可指定多個COMIC_ID
+{sys.argv[0]} gc-store
+    刪除圖片庫中未被任何章節使用的圖片
+{sys.argv[0]} serve
+    常駐模式，保持連線與快取，依序執行submit送出的工作
+{sys.argv[0]} submit 指令 ...
+    將指令（如dl-all [-o 下載位置] COMIC_ID）送到常駐程式執行，不等待完成
+{sys.argv[0]} jobs [JOB_ID]
+    列出常駐程式的工作，或顯示工作的狀態與輸出
+{sys.argv[0]} cancel JOB_ID
+    取消常駐程式的工作
 '''
         if removed:
             text += f'''{sys.argv[0]} dl-removed [-o 下載位置] COMIC_ID CHAPTER_ID ...
@@ -433,14 +1645,7 @@ class ExtractorBase(ExtractorNoChapterBase):
             if len(sys.argv) < 4:
                 self.show_help()
                 sys.exit(0)
-            for chapter_id in sys.argv[3:]:
-                if self.is_interrupted:
-                    return
-                try:
-                    self.downloadChapter(sys.argv[2], chapter_id, location)
-                except Exception as e:
-                    print(traceback.format_exc())
-                    print(f'章節 {chapter_id} 下載失敗：{e}')
+            self.download_chapters((sys.argv[2], chapter_id, location) for chapter_id in sys.argv[3:])
         elif sys.argv[1] == 'dl-seq' or sys.argv[1] == 'dl-all':
             if sys.argv[1] == 'dl-all':
                 sys.argv.append("1-r1")
@@ -448,28 +1653,29 @@ class ExtractorBase(ExtractorNoChapterBase):
             if len(sys.argv) < 4:
                 self.show_help()
                 sys.exit(0)
-            for comic in sys.argv[2:-1]:
-                if self.is_interrupted:
-                    return
-                try:
-                    chapter_list = self.getChapterList(comic)
-                except Exception as e:
-                    print(f'漫畫 {comic} 無法獲得章節清單：{e}')
-                    continue
-
-                for index in self.str_to_index(sys.argv[-1], len(list(chapter_list))):
-                    try:
-                        chapter_id = str(chapter_list[index].chapter_id)
-                    except IndexError:
-                        print(f'錯誤：沒有第{index + 1}章')
-                        continue
-                    if self.is_interrupted:
-                        return
-                    try:
-                        self.downloadChapter(comic, chapter_id, location)
-                    except Exception as e:
-                        print(traceback.format_exc())
-                        print(f'章節 {chapter_id} 下載失敗：{e}')
+            self.download_chapters(self.seq_jobs(sys.argv[2:-1], sys.argv[-1], location))
+        elif sys.argv[1] == 'sync':
+            location = self.get_location()
+            if len(sys.argv) < 3:
+                self.show_help()
+                sys.exit(0)
+            self.sync(sys.argv[2:], location)
+        elif sys.argv[1] == 'gc-store':
+            self.gc_store()
+        elif sys.argv[1] == 'serve':
+            self.serve()
+        elif sys.argv[1] == 'submit':
+            if len(sys.argv) < 3:
+                self.show_help()
+                sys.exit(0)
+            self.submit_job(sys.argv[2:])
+        elif sys.argv[1] == 'jobs':
+            self.show_jobs(sys.argv[2] if len(sys.argv) > 2 else None)
+        elif sys.argv[1] == 'cancel':
+            if len(sys.argv) != 3:
+                self.show_help()
+                sys.exit(0)
+            self.cancel_job(sys.argv[2])
         elif sys.argv[1] == 'dl-removed':
             location = self.get_location()
             if len(sys.argv) < 4:
@@ -514,9 +1720,207 @@ class ExtractorBase(ExtractorNoChapterBase):
         else:
             self.show_help()
 
-    @abstractmethod
+    def seq_jobs(self, comics, index_string, root):
+        """Generate chapters to download for dl-seq and dl-all
+
+        :param comics: ids of comic
+        :type comics: list[str]
+        :param index_string: user input string of chapter index
+        :type index_string: str
+        :param root: root directory of download location
+        :type root: str
+        :return: Generator of (comic_id, chapter_id, root)
+        :rtype: Iterator[tuple[str, str, str]]
+        """
+        def comic_jobs(comic, chapter_list):
+            try:
+                chapter_list = chapter_list.result()
+            except Exception as e:
+                print(f'漫畫 {comic} 無法獲得章節清單：{e}')
+                return
+
+            for index in self.str_to_index(index_string, len(list(chapter_list))):
+                try:
+                    chapter_id = str(chapter_list[index].chapter_id)
+                except IndexError:
+                    print(f'錯誤：沒有第{index + 1}章')
+                    continue
+                yield comic, chapter_id, root
+
+        # Chapter lists of all comics are fetched at once, and chapters of comics
+        # are interleaved, so comics are downloaded side by side in download pool
+        with ThreadPoolExecutor(max_workers=max(1, min(len(comics), self.config['chapter_list_parallelism']))) as list_pool:
+            comic_iterators = deque(comic_jobs(comic, list_pool.submit(self.getChapterList, comic)) for comic in comics)
+            while comic_iterators:
+                if self.is_interrupted:
+                    return
+                iterator = comic_iterators.popleft()
+                job = next(iterator, None)
+                if job is not None:
+                    yield job
+                    comic_iterators.append(iterator)
+
+    def download_chapters(self, jobs):
+        """Download chapters in order. Image lists of the next chapters are fetched
+        with prepareChapters() while images of the current chapter are downloading,
+        so the download pool does not wait for metadata.
+        Chapters completed according to manifest are skipped without network requests
+
+        :param jobs: Chapters to download
+        :type jobs: Iterable[tuple[str, str, str]]
+        """
+        lookahead = self.config['prefetch']
+        batch_size = max(1, self.config['chapter_batch'])
+        jobs = (job for job in iter(jobs) if not self.chapter_complete(*job))
+        # Batches of chapters whose image lists are being fetched
+        prepared = deque()
+        # Chapters whose images are being downloaded
+        submitted = deque()
+        with ThreadPoolExecutor(max_workers=max(1, lookahead)) as prefetch_pool:
+            def prefetch():
+                while len(prepared) < max(1, lookahead) and not self.is_interrupted:
+                    batch = list(itertools.islice(jobs, batch_size))
+                    if not batch:
+                        return
+                    prepared.append((batch, prefetch_pool.submit(self.prepareChapters, batch)))
+
+            prefetch()
+            while prepared and not self.is_interrupted:
+                batch, future = prepared.popleft()
+                try:
+                    results = future.result()
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (comic_id, chapter_id, root), image_download in zip(batch, results):
+                    if isinstance(image_download, Exception):
+                        print(''.join(traceback.format_exception(type(image_download), image_download, image_download.__traceback__)))
+                        print(f'章節 {chapter_id} 下載失敗：{image_download}')
+                        continue
+                    if image_download.chapter_key is None:
+                        image_download.chapter_key = f'{comic_id}/{chapter_id}'
+                    if image_download.refresh is None:
+                        image_download.refresh = functools.partial(self.refreshChapter, comic_id, chapter_id, root)
+                    submitted.append(self.submit_list(image_download))
+                if lookahead == 0:
+                    # No metadata requests while images are downloading
+                    while submitted:
+                        wait(submitted.popleft())
+                prefetch()
+                # Bound number of chapters queued in download pool, but keep submitting
+                # while few images are waiting, so workers are not idle at the end of
+                # short chapters or between comics
+                while submitted and all(f.done() for f in submitted[0]):
+                    submitted.popleft()
+                while len(submitted) > lookahead and self.pending_images(submitted) >= 2 * self.config['threads']:
+                    wait(submitted.popleft())
+            for futures in submitted:
+                wait(futures)
+
+    def pending_images(self, submitted):
+        """Number of submitted images not downloaded yet
+
+        :param submitted: Futures of submitted chapters
+        :type submitted: Iterable[list[concurrent.futures.Future]]
+        :rtype: int
+        """
+        return sum(not f.done() for futures in submitted for f in futures)
+
+    def sync(self, comics, root):
+        """Download new and newly unlocked chapters of comics, several comics at a time
+
+        :param comics: ids of comic
+        :type comics: list[str]
+        :param root: root directory of download location
+        :type root: str
+        """
+        if not self.config['manifest']:
+            # Downloaded chapters are only known from manifest, so every chapter would be fetched again
+            print('sync需要manifest，請勿設定manifest 0')
+            return
+        with ThreadPoolExecutor(max_workers=self.config['sync_parallelism']) as sync_pool:
+            for future in [sync_pool.submit(self.sync_comic, comic, root) for comic in comics]:
+                future.result()
+
+    def sync_comic(self, comic_id, root):
+        """Compare chapter list with state recorded in manifest and download
+        chapters which are not locked and not completely downloaded
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :param root: root directory of download location
+        :type root: str
+        """
+        if self.is_interrupted:
+            return
+        try:
+            chapter_list = self.getChapterList(comic_id)
+        except Exception as e:
+            print(f'漫畫 {comic_id} 無法獲得章節清單：{e}')
+            return
+        manifest = self.get_manifest(root)
+        previous = manifest.get_locked_status(comic_id)
+        jobs = []
+        for chapter in chapter_list:
+            chapter_id = str(chapter.chapter_id)
+            if chapter.locked_status == LockedStatus.locked or manifest.chapter_complete(f'{comic_id}/{chapter_id}'):
+                continue
+            if chapter_id not in previous:
+                print(f'新章節 {chapter.title}')
+            elif previous[chapter_id] == LockedStatus.locked:
+                print(f'新解鎖章節 {chapter.title}')
+            jobs.append((comic_id, chapter_id, root))
+        manifest.record_locked_status(comic_id, [(str(chapter.chapter_id), chapter.locked_status) for chapter in chapter_list])
+        self.download_chapters(jobs)
+
+    def chapter_complete(self, comic_id, chapter_id, root):
+        """Whether chapter is completely downloaded according to manifest
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :param chapter_id: id of chapter
+        :type chapter_id: str
+        :param root: root directory of download location
+        :type root: str
+        :rtype: bool
+        """
+        if not self.config['manifest'] or not Path(root, f'.{self.name}-manifest.sqlite3').exists():
+            return False
+        if self.get_manifest(root).chapter_complete(f'{comic_id}/{chapter_id}'):
+            print(f'章節 {chapter_id} 已下載，略過')
+            return True
+        return False
+
     def getChapterList(self, comic_id):
-        """Fetch chapter list from website
+        """Get chapter list, fetched by fetchChapterList() and cached for
+        chapter_list_ttl seconds. Concurrent calls for same comic share one fetch
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :return: List of chapter
+        :rtype: list[Chapter]
+        """
+        with self.chapter_list_lock(comic_id):
+            cached = self.chapter_list_cache.get(comic_id)
+            if cached and time.monotonic() - cached[0] < self.config['chapter_list_ttl']:
+                return cached[1]
+            chapter_list = self.fetchChapterList(comic_id)
+            if self.config['chapter_list_ttl'] > 0:
+                self.chapter_list_cache[comic_id] = (time.monotonic(), chapter_list)
+            return chapter_list
+
+    def chapter_list_lock(self, comic_id):
+        """Lock of cached chapter list of comic, held while it is fetched or dropped
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :rtype: threading.Lock
+        """
+        with self.lock:
+            return self.chapter_list_locks.setdefault(comic_id, threading.Lock())
+
+    @abstractmethod
+    def fetchChapterList(self, comic_id):
+        """Fetch chapter list from website, cached by getChapterList()
 
         :param comic_id: id of comic
         :type comic_id: str
@@ -525,6 +1929,16 @@ class ExtractorBase(ExtractorNoChapterBase):
         """
         pass
 
+    def invalidateChapterList(self, comic_id):
+        """Drop cached chapter list, call this after purchase state of comic is changed.
+        A fetch in progress finishes first, so its list is not cached afterwards
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        """
+        with self.chapter_list_lock(comic_id):
+            self.chapter_list_cache.pop(comic_id, None)
+
     def showChapterList(self, comic_id):
         """Display chapter list
 
@@ -537,7 +1951,6 @@ class ExtractorBase(ExtractorNoChapterBase):
             else:
                 print(index + 1, chapter.title)
 
-    @abstractmethod
     def downloadChapter(self, comic_id, chapter_id, root):
         """Fetch image list of chapter and download
 
@@ -548,8 +1961,52 @@ class ExtractorBase(ExtractorNoChapterBase):
         :param root: root directory of download location
         :type root: str
         """
+        self.download_list(self.prepareChapter(comic_id, chapter_id, root))
+
+    @abstractmethod
+    def prepareChapter(self, comic_id, chapter_id, root):
+        """Fetch image list of chapter without downloading, so download_chapters()
+        can prefetch following chapters
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :param chapter_id: id of chapter
+        :type chapter_id: str
+        :param root: root directory of download location
+        :type root: str
+        :return: ImageDownload object
+        :rtype: ImageDownload
+        """
         pass
 
+    def prepareChapters(self, jobs):
+        """Fetch image lists of several chapters, override this to fetch them
+        with fewer requests. Number of chapters is at most chapter_batch
+
+        :param jobs: Chapters to prepare
+        :type jobs: list[tuple[str, str, str]]
+        :return: ImageDownload object, or the exception raised, for each chapter
+        :rtype: list[ImageDownload | Exception]
+        """
+        results = []
+        for job in jobs:
+            try:
+                results.append(self.prepareChapter(*job))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def refreshChapter(self, comic_id, chapter_id, root):
+        """Fetch image list of chapter again with prepareChapters(), for new image auth
+
+        :return: ImageDownload object
+        :rtype: ImageDownload
+        """
+        image_download = self.prepareChapters([(comic_id, chapter_id, root)])[0]
+        if isinstance(image_download, Exception):
+            raise image_download
+        return image_download
+
     def getBoughtChapterList(self, comic_id):
         """Fetch bought chapter list from website
 
@@ -588,12 +2045,13 @@ class ExtractorBase(ExtractorNoChapterBase):
         sys.exit(0)
 
     def searchComic(self, query):
-        """Search comic with query
+        """Search comic with query, can be a generator yielding comics as pages
+        of search result are fetched
 
         :param query: search keyword
         :type query: str
-        :return: List of comic
-        :rtype: list[Comic]
+        :return: Iterable of comic
+        :rtype: Iterable[Comic]
         """
         self.show_help()
         sys.exit(0)
@@ -605,7 +2063,7 @@ class ExtractorBase(ExtractorNoChapterBase):
         :type query: str
         """
         for comic in self.searchComic(query):
-            print(comic.comic_id, comic.title)
+            print(comic.comic_id, comic.title, flush=True)
 
     def getTitleIndexFromChapterList(self, comic_id, chapter_id):
         """Get title and index of chapter, by calling getChapterList()
@@ -625,11 +2083,16 @@ class ExtractorBase(ExtractorNoChapterBase):
         raise Exception('Not used')
 
 class Comic:
+    __slots__ = ('comic_id', 'title')
+
     def __init__(self, comic_id, title):
         self.comic_id = comic_id
         self.title = title
 
 class Chapter:
+    # No __dict__ for each chapter, so chapter lists of large catalogs stay small
+    __slots__ = ('chapter_id', 'title', 'locked_status')
+
     def __init__(self, chapter_id, title, locked_status):
         self.chapter_id = chapter_id
         self.title = title
@@ -666,6 +2129,1415 @@ class ImageDownload:
         self.comic_title = comic_title
         self.chapter_title = chapter_title
         self.decrypt_info = None
+        # Key of chapter in manifest, None to not use manifest
+        self.chapter_key = None
+        self.manifest = None
+        # Request of ZIP archive of all images, images are requested one by one if it fails
+        self.packed_request = None
+        # Function returning ImageDownload of the same chapter with new auth, None if not supported
+        self.refresh = None
+        self.refresh_lock = threading.Lock()
+        # Whether requests were refreshed, chapter is refreshed at most once
+        self.refreshed = False
+
+class DirectoryOutput:
+    """Write images of chapter as files in its directory
+
+    :param path: download location of chapter
+    :type path: Path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Recorded in manifest, chapter is downloaded again if it is removed
+        self.location = path
+
+    def size(self, filename):
+        """Size of downloaded image, None if it does not exist
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: int | None
+        """
+        try:
+            return filename.stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def open(self, filename):
+        """Open temporary file to be renamed to filename by commit()
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: BinaryIO
+        """
+        return filename.with_name(filename.name + '.part').open('wb')
+
+    def commit(self, f, filename):
+        """Flush temporary file to disk, close it and rename it to filename
+
+        :param f: file returned by open()
+        :type f: BinaryIO
+        :param filename: filename of image
+        :type filename: Path
+        """
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(f.name, filename)
+
+    def discard(self, f):
+        """Close and remove temporary file returned by open()
+
+        :type f: BinaryIO
+        """
+        f.close()
+        Path(f.name).unlink(missing_ok=True)
+
+    def keep(self, filename):
+        """Keep image downloaded before"""
+        pass
+
+    def link(self, source, filename):
+        """Put image in store into directory as hardlink, or copy if hardlink is not supported
+
+        :param source: filename of image in store
+        :type source: Path
+        :param filename: filename of image
+        :type filename: Path
+        """
+        temp = filename.with_name(filename.name + '.part')
+        temp.unlink(missing_ok=True)
+        try:
+            try:
+                os.link(source, temp)
+            except OSError:
+                shutil.copyfile(source, temp)
+            os.replace(temp, filename)
+        except:
+            temp.unlink(missing_ok=True)
+            raise
+
+    def checksum(self, filename):
+        """Size and SHA-256 of downloaded image
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: tuple[int, str]
+        """
+        checksum = hashlib.sha256()
+        size = 0
+        with filename.open('rb') as f:
+            while chunk := f.read(1 << 20):
+                checksum.update(chunk)
+                size += len(chunk)
+        return size, checksum.hexdigest()
+
+    def close(self):
+        pass
+
+class CbzOutput:
+    """Write images of chapter into a CBZ archive next to its directory, in page order.
+    Images completed out of order are kept in memory until previous pages are written.
+    Archive is written to a temporary file, which replaces existing archive when chapter
+    is finished. Images in existing archive are copied instead of downloaded again
+
+    Index of image is taken from its filename, see get_image_filename()
+
+    :param path: download location of chapter, archive is written to path.cbz
+    :type path: Path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.location = path.with_name(path.name + '.cbz')
+        self.lock = threading.Lock()
+        # Previous archive, its central directory tells which images are downloaded
+        self.previous = None
+        self.previous_entries = {}
+        if self.location.exists():
+            try:
+                self.previous = zipfile.ZipFile(self.location)
+                self.previous_entries = {info.filename: info for info in self.previous.infolist()}
+            except zipfile.BadZipFile:
+                print(self.location, '已損壞，重新下載')
+        # name -> (size, sha256) of images downloaded in this run
+        self.downloaded = {}
+        # idx -> (name, content), content is None for images in previous archive
+        self.pending = {}
+        self.next_idx = 1
+        # Images in previous archive before first downloaded image, copied when archive is opened
+        self.kept = []
+        self.file = None
+        self.archive = None
+
+    def size(self, filename):
+        """Size of downloaded image, None if it does not exist
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: int | None
+        """
+        with self.lock:
+            if filename.name in self.downloaded:
+                return self.downloaded[filename.name][0]
+            info = self.previous_entries.get(filename.name)
+            return info.file_size if info else None
+
+    def open(self, filename):
+        """Open memory buffer for image, written into archive by commit()
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: BinaryIO
+        """
+        return io.BytesIO()
+
+    def commit(self, f, filename):
+        """Queue image for writing into archive
+
+        :param f: buffer returned by open()
+        :type f: io.BytesIO
+        :param filename: filename of image
+        :type filename: Path
+        """
+        content = f.getvalue()
+        with self.lock:
+            self.downloaded[filename.name] = (len(content), hashlib.sha256(content).hexdigest())
+            self.add(int(filename.stem), filename.name, content)
+
+    def discard(self, f):
+        """Drop buffer returned by open()
+
+        :type f: io.BytesIO
+        """
+        f.close()
+
+    def link(self, source, filename):
+        """Queue image in store for writing into archive
+
+        :param source: filename of image in store
+        :type source: Path
+        :param filename: filename of image
+        :type filename: Path
+        """
+        f = self.open(filename)
+        f.write(source.read_bytes())
+        self.commit(f, filename)
+
+    def keep(self, filename):
+        """Queue image in previous archive for copying into new archive
+
+        :param filename: filename of image
+        :type filename: Path
+        """
+        with self.lock:
+            if filename.name not in self.downloaded:
+                self.add(int(filename.stem), filename.name, None)
+
+    def checksum(self, filename):
+        """Size and SHA-256 of downloaded image
+
+        :param filename: filename of image
+        :type filename: Path
+        :rtype: tuple[int, str]
+        """
+        with self.lock:
+            if filename.name in self.downloaded:
+                return self.downloaded[filename.name]
+            content = self.previous.read(filename.name)
+        return len(content), hashlib.sha256(content).hexdigest()
+
+    def add(self, idx, name, content):
+        self.pending[idx] = (name, content)
+        while self.next_idx in self.pending:
+            self.write(*self.pending.pop(self.next_idx))
+            self.next_idx += 1
+
+    def write(self, name, content):
+        if self.archive is None:
+            if content is None:
+                # Archive is rewritten only if there are new images
+                self.kept.append(name)
+                return
+            self.file = self.location.with_name(self.location.name + '.part').open('wb')
+            # Images are already compressed
+            self.archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+            for kept in self.kept:
+                self.write(kept, None)
+        if content is None:
+            self.archive.writestr(self.previous_entries[name], self.previous.read(name))
+        else:
+            self.archive.writestr(name, content)
+
+    def close(self):
+        """Write remaining images after missing pages, and replace previous archive.
+        Images of previous archive which were neither kept nor downloaded again,
+        e.g. page failed or download was interrupted, are copied too"""
+        with self.lock:
+            for name in self.previous_entries:
+                stem = Path(name).stem
+                if stem.isdigit() and int(stem) >= self.next_idx and int(stem) not in self.pending:
+                    self.pending[int(stem)] = (name, None)
+            for idx in sorted(self.pending):
+                self.write(*self.pending[idx])
+            self.pending.clear()
+            if self.archive is not None:
+                self.archive.close()
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+            if self.previous is not None:
+                self.previous.close()
+            if self.archive is not None:
+                os.replace(self.file.name, self.location)
+
+class FairExecutor(Executor):
+    """Thread pool taking turns between keys, e.g. comics, so every key gets a fair
+    share of workers no matter how many tasks it has queued. Tasks of the same key
+    run in submission order, and idle workers take the next task of any key
+
+    :param max_workers: number of worker threads
+    :type max_workers: int
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        # Maximum running tasks of each key, 0 for unlimited
+        self.max_workers_per_key = 0
+        # Maximum running tasks of all keys, can be lowered below max_workers by set_limit()
+        self.limit = max_workers
+        self.condition = threading.Condition()
+        # key -> deque of (future, fn, args, kwargs)
+        self.queues = {}
+        # Keys with queued tasks, in turn order
+        self.turns = deque()
+        # key -> number of running tasks
+        self.running = {}
+        self.active = 0
+        self.threads = []
+        self.is_shutdown = False
+        atexit.register(self.shutdown)
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.submit_keyed(None, fn, *args, **kwargs)
+
+    def submit_keyed(self, key, fn, /, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) in turn of key
+
+        :param key: key sharing workers fairly with other keys
+        :type key: Hashable
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        with self.condition:
+            if self.is_shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.turns.append(key)
+            self.queues[key].append((future, fn, args, kwargs))
+            if len(self.threads) < self.max_workers and len(self.threads) < self.active + self.queued():
+                thread = threading.Thread(target=self.worker, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            self.condition.notify()
+        return future
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def set_limit(self, limit):
+        """Change number of tasks allowed to run at once, between 1 and max_workers,
+        called by ConcurrencyTuner when autotune is on
+
+        :type limit: int
+        """
+        with self.condition:
+            self.limit = max(1, min(self.max_workers, limit))
+            self.condition.notify_all()
+
+    def next_task(self):
+        """Take first task of next key which can run more tasks, condition must be held
+
+        :return: key and task, or None if no task can run
+        """
+        if self.active >= self.limit:
+            return None
+        for _ in range(len(self.turns)):
+            key = self.turns.popleft()
+            if self.max_workers_per_key and self.running.get(key, 0) >= self.max_workers_per_key:
+                self.turns.append(key)
+                continue
+            queue = self.queues[key]
+            task = queue.popleft()
+            if queue:
+                self.turns.append(key)
+            else:
+                del self.queues[key]
+            return key, task
+        return None
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while (item := self.next_task()) is None:
+                    if self.is_shutdown and not self.queues:
+                        return
+                    self.condition.wait()
+                key, (future, fn, args, kwargs) = item
+                self.active += 1
+                self.running[key] = self.running.get(key, 0) + 1
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            # Do not keep result alive while waiting for next task
+            del future, fn, args, kwargs
+            with self.condition:
+                self.active -= 1
+                self.running[key] -= 1
+                if not self.running[key]:
+                    del self.running[key]
+                # Task of key waiting for per-key limit may run now
+                self.condition.notify_all()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.condition:
+            self.is_shutdown = True
+            if cancel_futures:
+                for queue in self.queues.values():
+                    for future, *_ in queue:
+                        future.cancel()
+                self.queues.clear()
+                self.turns.clear()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+class JobQueue:
+    """Jobs of daemon mode, run one by one in submission order
+
+    :param cancel_running: Function interrupting running job
+    :type cancel_running: Callable[[], None]
+    :param roots: Directories which download locations of jobs must be in
+    :type roots: list[str]
+    """
+
+    # Commands which can not run as job
+    rejected_commands = ('serve', 'submit', 'jobs', 'cancel', 'login')
+    # Number of output writes kept for each job
+    output_limit = 1000
+
+    def __init__(self, cancel_running, roots):
+        self.cancel_running = cancel_running
+        self.roots = [Path(root).resolve() for root in roots]
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        # id -> job
+        self.jobs = {}
+        self.next_id = 1
+
+    def add(self, args, cwd):
+        """Queue job
+
+        :param args: command line arguments
+        :type args: list[str]
+        :param cwd: working directory, for relative download location
+        :type cwd: str
+        :return: job
+        :rtype: dict
+        """
+        with self.lock:
+            job = {'id': self.next_id, 'args': args, 'cwd': cwd, 'status': 'queued', 'error': None,
+                   'submitted': time.time(), 'started': None, 'finished': None,
+                   'output': deque(maxlen=self.output_limit)}
+            self.jobs[job['id']] = job
+            self.next_id += 1
+        self.queue.put(job)
+        return job
+
+    def is_allowed_location(self, args, cwd):
+        """Whether download location of job (-o, relative to cwd) is in one of roots
+
+        :param args: command line arguments
+        :type args: list[str]
+        :param cwd: working directory of job
+        :type cwd: str
+        :rtype: bool
+        """
+        if not os.path.isabs(cwd):
+            return False
+        location = ''
+        if '-o' in args:
+            pos = args.index('-o')
+            if pos + 1 < len(args):
+                location = args[pos + 1]
+        location = Path(cwd, location).resolve()
+        return any(location.is_relative_to(root) for root in self.roots)
+
+    def cancel(self, job):
+        """Cancel queued job, or interrupt running job
+
+        :type job: dict
+        """
+        with self.lock:
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+            elif job['status'] == 'running':
+                job['status'] = 'cancelling'
+                self.cancel_running()
+
+    def describe(self, job, output=False):
+        """JSON serializable copy of job
+
+        :type job: dict
+        :param output: Whether to include output of job
+        :type output: bool
+        :rtype: dict
+        """
+        with self.lock:
+            description = {key: value for key, value in job.items() if key != 'output'}
+            if output:
+                description['output'] = ''.join(job['output'])
+        return description
+
+class JobOutput(io.TextIOBase):
+    """stdout while job is running, written to both job and daemon output"""
+
+    def __init__(self, job, stdout):
+        self.job = job
+        self.stdout = stdout
+
+    def write(self, text):
+        self.job['output'].append(text)
+        return self.stdout.write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Local HTTP API of daemon mode
+
+    POST /jobs with {"args": [...], "cwd": "..."} queues job,
+    GET /jobs lists jobs, GET /jobs/ID shows job with output,
+    DELETE /jobs/ID cancels job.
+    Requests must have Host of localhost and token of daemon in Authorization header
+    """
+
+    # Other hosts may be web pages using DNS rebinding
+    allowed_hosts = ('localhost', '127.0.0.1')
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_request(self):
+        """Parse request line and headers, and reject request of any method
+        before do_* is called if Host or token is wrong
+
+        :rtype: bool
+        """
+        return super().parse_request() and self.check_request()
+
+    def check_request(self):
+        """Check Host and token of request, error response is sent if rejected
+
+        :rtype: bool
+        """
+        if self.headers.get('Host', '').partition(':')[0] not in self.allowed_hosts:
+            self.send_json(403, {'error': '不允許的Host'})
+            return False
+        authorization = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {self.server.token}'.encode()):
+            self.send_json(403, {'error': 'token錯誤'})
+            return False
+        return True
+
+    def get_job(self):
+        """Job of /jobs/ID, error response is sent if not found
+
+        :rtype: dict | None
+        """
+        jobs = self.server.jobs
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit() and int(parts[1]) in jobs.jobs:
+            return jobs.jobs[int(parts[1])]
+        self.send_json(404, {'error': '找不到工作'})
+        return None
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path.rstrip('/') == '/jobs':
+            self.send_json(200, [jobs.describe(job) for job in list(jobs.jobs.values())])
+        elif job := self.get_job():
+            self.send_json(200, jobs.describe(job, output=True))
+
+    def do_POST(self):
+        jobs = self.server.jobs
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': '找不到路徑'})
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': 'Content-Type必須為application/json'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            args = [str(arg) for arg in request['args']]
+            cwd = str(request.get('cwd') or os.getcwd())
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': '格式錯誤'})
+            return
+        if not args or args[0] in jobs.rejected_commands:
+            self.send_json(400, {'error': '不支持的指令'})
+            return
+        if not jobs.is_allowed_location(args, cwd):
+            self.send_json(403, {'error': '下載位置不在允許的目錄中'})
+            return
+        self.send_json(201, jobs.describe(jobs.add(args, cwd)))
+
+    def do_DELETE(self):
+        jobs = self.server.jobs
+        if job := self.get_job():
+            jobs.cancel(job)
+            self.send_json(200, jobs.describe(job))
+
+    def log_message(self, format, *args):
+        pass
+
+class AsyncEngine:
+    """Event loop running in a background thread, performing all HTTP requests
+    of an extractor with httpx.AsyncClient
+
+    :param client: Client for API requests
+    :type client: httpx.AsyncClient
+    :param image_client: Client for image downloads
+    :type image_client: httpx.AsyncClient
+    :param concurrency: Maximum number of in-flight image downloads, can be lowered by set_limit()
+    :type concurrency: int
+    :param threads: Number of threads for image decryption and file writing
+    :type threads: int
+    """
+
+    def __init__(self, client, image_client, concurrency, threads):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = client
+        self.image_client = image_client
+        self.max_limit = concurrency
+        self.limit = concurrency
+        self.active = 0
+        self.condition = asyncio.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def run(self, coro):
+        """Schedule coroutine on event loop
+
+        :return: Future of result of coroutine
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro):
+        """Run coroutine on event loop and wait for its result"""
+        return self.run(coro).result()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Wait until less than limit image downloads are in flight, and take one slot"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def set_limit(self, limit):
+        """Change number of image downloads allowed in flight, between 1 and concurrency
+
+        :type limit: int
+        """
+        async def resize():
+            async with self.condition:
+                self.limit = max(1, min(self.max_limit, limit))
+                self.condition.notify_all()
+        self.run(resize())
+
+    def run_in_executor(self, func, *args):
+        """Run func in executor from event loop, with context of current task,
+        so metrics are recorded to page being downloaded
+
+        :rtype: asyncio.Future
+        """
+        return self.loop.run_in_executor(self.executor, contextvars.copy_context().run, func, *args)
+
+class Manifest:
+    """Download state of chapters and pages, stored in SQLite database in download root
+
+    :param filename: filename of database
+    :type filename: Path
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS chapters (key TEXT PRIMARY KEY, path TEXT, page_count INTEGER, complete INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT, idx INTEGER, filename TEXT, size INTEGER, sha256 TEXT, PRIMARY KEY (key, idx))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS locked_status (comic_id TEXT, chapter_id TEXT, locked_status INTEGER, PRIMARY KEY (comic_id, chapter_id))')
+
+    def chapter_complete(self, key):
+        """Whether all pages of chapter are downloaded and its directory or archive still exists
+
+        :param key: key of chapter
+        :type key: str
+        :rtype: bool
+        """
+        with self.lock:
+            row = self.db.execute('SELECT path, complete FROM chapters WHERE key = ?', (key,)).fetchone()
+        return bool(row and row[1] and Path(row[0]).exists())
+
+    def start_chapter(self, key, path, page_count):
+        """Record chapter with expected page count, as not complete
+
+        :param key: key of chapter
+        :type key: str
+        :param path: directory or archive of chapter
+        :type path: Path
+        :param page_count: number of pages
+        :type page_count: int
+        """
+        # Absolute, so existence does not depend on working directory
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, 0)', (key, str(Path(path).resolve()), page_count))
+
+    def finish_chapter(self, key):
+        with self.lock:
+            self.db.execute('UPDATE chapters SET complete = 1 WHERE key = ?', (key,))
+
+    def get_page(self, key, idx):
+        """Get recorded page
+
+        :param key: key of chapter
+        :type key: str
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :return: filename, size and sha256 of page, or None if not recorded
+        :rtype: tuple[str, int, str] | None
+        """
+        with self.lock:
+            return self.db.execute('SELECT filename, size, sha256 FROM pages WHERE key = ? AND idx = ?', (key, idx)).fetchone()
+
+    def record_page(self, key, idx, filename, size, sha256):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)', (key, idx, filename, size, sha256))
+
+    def page_checksums(self):
+        """SHA-256 of pages of chapters whose directory or archive still exists
+
+        :rtype: set[str]
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT chapters.path, pages.sha256 FROM pages JOIN chapters ON pages.key = chapters.key').fetchall()
+        exists = {}
+        checksums = set()
+        for path, sha256 in rows:
+            if path not in exists:
+                exists[path] = Path(path).exists()
+            if exists[path]:
+                checksums.add(sha256)
+        return checksums
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get_locked_status(self, comic_id):
+        """Get locked status of chapters recorded by last sync
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :return: chapter_id -> LockedStatus
+        :rtype: dict[str, int]
+        """
+        with self.lock:
+            return dict(self.db.execute('SELECT chapter_id, locked_status FROM locked_status WHERE comic_id = ?', (comic_id,)))
+
+    def record_locked_status(self, comic_id, chapters):
+        """Record locked status of chapters
+
+        :param comic_id: id of comic
+        :type comic_id: str
+        :param chapters: list of (chapter_id, LockedStatus)
+        :type chapters: list[tuple[str, int]]
+        """
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO locked_status VALUES (?, ?, ?)', [(comic_id, chapter_id, status) for chapter_id, status in chapters])
+
+class PageStore:
+    """Content-addressed store of images shared by download roots. Each image is
+    stored once per SHA-256 of its content and hardlinked into chapter directories.
+    Images are indexed by url without query string, so images repeated in episodes
+    and volumes, or downloaded into another root, are not downloaded again.
+    Manifests of roots using the store are recorded, as gc() keeps images they reference
+
+    :param path: directory of store
+    :type path: Path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temp = path / 'tmp'
+        self.temp.mkdir(parents=True, exist_ok=True)
+        # Long timeout, as gc() holds write lock while removing images
+        self.db = sqlite3.connect(path / 'index.sqlite3', timeout=600, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS manifests (path TEXT PRIMARY KEY)')
+
+    def key(self, url):
+        """Key of image url, query string usually holds expiring signature
+
+        :type url: httpx.URL
+        :rtype: str
+        """
+        return str(url.copy_with(query=None))
+
+    def object_filename(self, sha256):
+        return self.path / 'objects' / sha256[:2] / sha256
+
+    def get(self, url):
+        """Get stored image of url
+
+        :param url: url of image
+        :type url: httpx.URL
+        :return: filename of image in store, None if it is not stored
+        :rtype: Path | None
+        """
+        with self.lock:
+            row = self.db.execute('SELECT sha256, size FROM urls WHERE url = ?', (self.key(url),)).fetchone()
+        if row is None:
+            return None
+        filename = self.object_filename(row[0])
+        try:
+            if filename.stat().st_size == row[1]:
+                # Images used after gc() starts are kept
+                os.utime(filename)
+                return filename
+        except FileNotFoundError:
+            pass
+        return None
+
+    def add_manifest(self, filename):
+        """Record manifest of download root using store
+
+        :param filename: filename of manifest
+        :type filename: Path
+        """
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO manifests VALUES (?)', (str(filename.resolve()),))
+
+    def temp_filename(self, filename):
+        """Filename for downloading image before it is added to store
+
+        :param filename: filename of image in chapter
+        :type filename: Path
+        :rtype: Path
+        """
+        return self.temp / (os.urandom(8).hex() + filename.suffix)
+
+    def add(self, url, filename):
+        """Move downloaded image into store
+
+        :param url: url of image
+        :type url: httpx.URL
+        :param filename: filename of downloaded image, returned by temp_filename()
+        :type filename: Path
+        :return: filename of image in store
+        :rtype: Path
+        """
+        checksum = hashlib.sha256()
+        size = 0
+        with filename.open('rb') as f:
+            while chunk := f.read(1 << 20):
+                checksum.update(chunk)
+                size += len(chunk)
+        sha256 = checksum.hexdigest()
+        stored = self.object_filename(sha256)
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            # Serialized with removal in gc(), also in other processes
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                # Same content, replacing also marks image as used after gc() starts
+                os.replace(filename, stored)
+                os.utime(stored)
+                self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (self.key(url), sha256, size))
+            finally:
+                self.db.execute('COMMIT')
+        return stored
+
+    def gc(self, temp_age=86400):
+        """Remove images not referenced by pages of existing chapters in recorded
+        manifests, and temporary files older than temp_age left by interrupted downloads.
+        Images added or used after gc starts are kept, so concurrent downloads are not affected
+
+        :param temp_age: minimum age of removed temporary files in seconds
+        :type temp_age: float
+        :return: number and total size of removed files
+        :rtype: tuple[int, int]
+        """
+        start = time.time()
+        referenced = set()
+        with self.lock:
+            manifests = [row[0] for row in self.db.execute('SELECT path FROM manifests')]
+        for path in manifests:
+            if not Path(path).exists():
+                with self.lock:
+                    self.db.execute('DELETE FROM manifests WHERE path = ?', (path,))
+                continue
+            manifest = Manifest(Path(path))
+            try:
+                referenced |= manifest.page_checksums()
+            finally:
+                manifest.close()
+        candidates = []
+        if manifests:
+            candidates = [filename for filename in self.path.glob('objects/*/*') if filename.name not in referenced]
+        count = size = 0
+        removed = []
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for filename in candidates:
+                    try:
+                        stat = filename.stat()
+                        if stat.st_mtime >= start:
+                            continue
+                        filename.unlink()
+                    except FileNotFoundError:
+                        continue
+                    removed.append((filename.name,))
+                    count += 1
+                    size += stat.st_size
+                self.db.executemany('DELETE FROM urls WHERE sha256 = ?', removed)
+            finally:
+                self.db.execute('COMMIT')
+        now = time.time()
+        for filename in self.temp.iterdir():
+            stat = filename.stat()
+            if now - stat.st_mtime > temp_age:
+                filename.unlink()
+                count += 1
+                size += stat.st_size
+        return count, size
+
+class RateLimiter:
+    """Token buckets of requests per second and bytes per second, shared by all
+    download workers. Each bucket holds up to one second of tokens. Callers reserve
+    tokens and sleep for returned delay, so both threads and coroutines can use it.
+
+    Request rate is adapted with AIMD: it is halved when server responds 429, at most
+    once per second, and increases by about one request per second every second
+    after successful requests, up to request_rate. If request_rate is 0, requests are
+    unlimited until the first 429, which halves measured request rate.
+
+    Limits are per process, download workers are threads of this process
+
+    :param request_rate: maximum requests per second, 0 for unlimited
+    :type request_rate: float
+    :param byte_rate: maximum bytes per second, 0 for unlimited
+    :type byte_rate: float
+    """
+
+    # Lowest request rate after decrease by 429 responses
+    min_request_rate = 0.1
+    # Indices of state
+    NEXT_REQUEST, NEXT_BYTE, REQUEST_RATE, WINDOW_START, WINDOW_COUNT, MEASURED_RATE, LAST_DECREASE = range(7)
+
+    def __init__(self, request_rate, byte_rate):
+        self.request_rate = request_rate
+        self.byte_rate = byte_rate
+        self.lock = threading.Lock()
+        self.state = [0.0] * 7
+        self.state[self.REQUEST_RATE] = request_rate
+        self.state[self.WINDOW_START] = time.monotonic()
+
+    def take(self, index, tokens, rate, now):
+        """Take tokens from bucket, state[index] is the time when bucket is full again
+
+        :return: Seconds to wait until tokens are taken without overdrawing bucket
+        :rtype: float
+        """
+        full_time = max(self.state[index], now) + tokens / rate
+        self.state[index] = full_time
+        # Bucket holds one second of tokens, or at least the tokens taken at once
+        return max(0.0, full_time - max(1.0, tokens / rate) - now)
+
+    def reserve_request(self):
+        """Reserve a request
+
+        :return: Seconds to wait before sending request
+        :rtype: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            state = self.state
+            if now - state[self.WINDOW_START] >= 1:
+                state[self.MEASURED_RATE] = state[self.WINDOW_COUNT] / (now - state[self.WINDOW_START])
+                state[self.WINDOW_START] = now
+                state[self.WINDOW_COUNT] = 0
+            state[self.WINDOW_COUNT] += 1
+            if state[self.REQUEST_RATE] <= 0:
+                return 0.0
+            return self.take(self.NEXT_REQUEST, 1, state[self.REQUEST_RATE], now)
+
+    def reserve_bytes(self, size):
+        """Reserve bandwidth for received bytes
+
+        :param size: number of bytes received
+        :type size: int
+        :return: Seconds to wait before sending next request
+        :rtype: float
+        """
+        if self.byte_rate <= 0 or size <= 0:
+            return 0.0
+        with self.lock:
+            return self.take(self.NEXT_BYTE, size, self.byte_rate, time.monotonic())
+
+    def record(self, response):
+        """Adapt request rate to response
+
+        :type response: httpx.Response
+        """
+        with self.lock:
+            state = self.state
+            rate = state[self.REQUEST_RATE]
+            if response.status_code == 429:
+                now = time.monotonic()
+                if now - state[self.LAST_DECREASE] < 1:
+                    return
+                state[self.LAST_DECREASE] = now
+                if rate <= 0:
+                    # Requests in current window, which is shorter than one second
+                    rate = max(state[self.MEASURED_RATE], state[self.WINDOW_COUNT])
+                state[self.REQUEST_RATE] = max(self.min_request_rate, rate / 2)
+            elif rate > 0 and response.is_success:
+                rate += 1 / rate
+                state[self.REQUEST_RATE] = min(rate, self.request_rate) if self.request_rate > 0 else rate
+
+class Metrics:
+    """Metrics of downloads, shown as live progress line and exported as JSON lines
+    or Prometheus text format. Time of each page is split into fetch (network,
+    including retries and rate limiting), decrypt (CPU) and write (disk) time,
+    so it shows which one bounds a slow run
+
+    :param export: filename to export metrics, empty to not export
+    :type export: str
+    :param export_format: jsonl for one line per page and chapter appended while
+        downloading, prometheus for text format rewritten after each chapter
+    :type export_format: str
+    :param progress: Whether to show live progress line
+    :type progress: bool
+    """
+
+    # Page being downloaded by current thread or task
+    current_page = contextvars.ContextVar('current_page', default=None)
+    # Upper bounds of page fetch time histogram
+    fetch_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    page_statuses = ('downloaded', 'stored', 'skipped', 'failed', 'cancelled')
+    stages = ('fetch', 'decrypt', 'write')
+
+    def __init__(self, export='', export_format='jsonl', progress=False):
+        self.export = export
+        self.export_format = export_format
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.pages = dict.fromkeys(self.page_statuses, 0)
+        self.chapters = {True: 0, False: 0}
+        self.seconds = dict.fromkeys(self.stages + ('chapter',), 0.0)
+        self.bytes = 0
+        self.retries = 0
+        self.fetch_counts = [0] * (len(self.fetch_buckets) + 1)
+        # Pages waiting in download pool
+        self.queued = 0
+        self.active = 0
+        self.file = None
+        if export and export_format == 'jsonl':
+            self.file = open(export, 'a', encoding='utf-8')
+        self.stopped = threading.Event()
+        self.progress_thread = None
+        if progress:
+            self.progress_thread = threading.Thread(target=self.show_progress, daemon=True)
+            self.progress_thread.start()
+
+    def queue_pages(self, count):
+        with self.lock:
+            self.queued += count
+
+    def start_page(self):
+        """Start timing page in current thread or task
+
+        :return: Metrics of page, passed to finish_page()
+        :rtype: dict
+        """
+        page = {'start': time.perf_counter(), 'bytes': 0, 'retries': 0, 'decrypt': 0.0, 'write': 0.0}
+        self.current_page.set(page)
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        return page
+
+    @contextlib.contextmanager
+    def timing(self, stage):
+        """Add time spent in with block to stage of current page"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            page = self.current_page.get()
+            if page is not None:
+                page[stage] += time.perf_counter() - start
+
+    def retry(self):
+        page = self.current_page.get()
+        if page is not None:
+            page['retries'] += 1
+        with self.lock:
+            self.retries += 1
+
+    def received(self, size):
+        page = self.current_page.get()
+        if page is not None:
+            page['bytes'] += size
+        with self.lock:
+            self.bytes += size
+
+    def finish_page(self, page, path, idx, status):
+        """Record metrics of page
+
+        :param page: returned by start_page()
+        :type page: dict
+        :param path: Download location
+        :type path: Path
+        :param idx: index (page number) of image, starts from 1
+        :type idx: int
+        :param status: one of page_statuses, None if page is queued again
+        :type status: str | None
+        """
+        self.current_page.set(None)
+        seconds = time.perf_counter() - page['start']
+        fetch = max(0.0, seconds - page['decrypt'] - page['write'])
+        with self.lock:
+            self.active -= 1
+            if status is None:
+                self.queued += 1
+                return
+            self.pages[status] += 1
+            if status == 'downloaded':
+                self.seconds['fetch'] += fetch
+                self.seconds['decrypt'] += page['decrypt']
+                self.seconds['write'] += page['write']
+                self.fetch_counts[bisect.bisect_left(self.fetch_buckets, fetch)] += 1
+            if self.file:
+                self.file.write(json.dumps({'type': 'page', 'time': time.time(), 'chapter': str(path), 'page': idx,
+                                            'status': status, 'seconds': seconds, 'fetch': fetch,
+                                            'decrypt': page['decrypt'], 'write': page['write'],
+                                            'bytes': page['bytes'], 'retries': page['retries']}, ensure_ascii=False) + '\n')
+
+    def finish_chapter(self, path, page_count, seconds, success):
+        """Record metrics of chapter
+
+        :param path: Download location
+        :type path: Path
+        :param page_count: number of pages
+        :type page_count: int
+        :param seconds: wall time of chapter
+        :type seconds: float
+        :param success: Whether all pages are downloaded
+        :type success: bool
+        """
+        with self.lock:
+            self.chapters[success] += 1
+            self.seconds['chapter'] += seconds
+            if self.file:
+                self.file.write(json.dumps({'type': 'chapter', 'time': time.time(), 'chapter': str(path),
+                                            'pages': page_count, 'seconds': seconds, 'success': success},
+                                           ensure_ascii=False) + '\n')
+                self.file.flush()
+        if self.export and self.export_format == 'prometheus':
+            self.write_prometheus()
+
+    def progress_line(self):
+        """Aggregated progress, with share of fetch, decrypt and write time of downloaded pages
+
+        :rtype: str
+        """
+        with self.lock:
+            done = sum(self.pages.values())
+            total = done + self.queued + self.active
+            busy = sum(self.seconds[stage] for stage in self.stages) or 1
+            share = ' '.join(f'{self.seconds[stage] / busy:.0%}' for stage in self.stages)
+            speed = self.bytes / (time.perf_counter() - self.start_time) / (1 << 20)
+            return (f'頁 {done}/{total} 失敗 {self.pages["failed"]} 重試 {self.retries} | {speed:.2f} MiB/s | '
+                    f'排隊 {self.queued} 下載中 {self.active} | 網路/解密/寫入 {share}')
+
+    def show_progress(self):
+        while not self.stopped.wait(1):
+            print('\r' + self.progress_line(), end='', file=sys.stderr, flush=True)
+
+    def prometheus_text(self):
+        """Metrics in Prometheus text exposition format
+
+        :rtype: str
+        """
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append(f'# TYPE jumpplusext_{name} {kind}')
+            for labels, value in samples:
+                lines.append(f'jumpplusext_{name}{labels} {value}')
+
+        with self.lock:
+            metric('pages_total', 'counter', [(f'{{status="{status}"}}', count) for status, count in self.pages.items()])
+            metric('chapters_total', 'counter', [('{status="complete"}', self.chapters[True]),
+                                                 ('{status="incomplete"}', self.chapters[False])])
+            metric('received_bytes_total', 'counter', [('', self.bytes)])
+            metric('retries_total', 'counter', [('', self.retries)])
+            metric('page_stage_seconds_total', 'counter', [(f'{{stage="{stage}"}}', self.seconds[stage]) for stage in self.stages])
+            metric('chapter_seconds_total', 'counter', [('', self.seconds['chapter'])])
+            buckets = []
+            count = 0
+            for bound, bucket_count in zip(self.fetch_buckets + ('+Inf',), self.fetch_counts):
+                count += bucket_count
+                buckets.append((f'_bucket{{le="{bound}"}}', count))
+            metric('page_fetch_seconds', 'histogram', buckets + [('_sum', self.seconds['fetch']), ('_count', count)])
+            metric('queued_pages', 'gauge', [('', self.queued)])
+            metric('active_pages', 'gauge', [('', self.active)])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        temp = self.export + '.part'
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp, self.export)
+
+    def close(self):
+        """Stop progress line and write remaining metrics"""
+        if self.progress_thread:
+            self.stopped.set()
+            self.progress_thread.join()
+            print('\r' + self.progress_line(), file=sys.stderr, flush=True)
+        if self.export and self.export_format == 'prometheus':
+            self.write_prometheus()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class ConcurrencyTuner:
+    """Adjust number of concurrent image downloads from metrics of downloaded pages,
+    between 1 and max_limit. Throughput is concurrency divided by latency, so while
+    latency stays near the lowest latency seen the limit grows, and once more
+    downloads at once only wait longer at CDN (the knee, or CDN slowing down) it
+    shrinks by the ratio of lowest to recent latency. Limit is cut multiplicatively
+    when many requests are retried
+
+    :param metrics: Metrics of downloads
+    :type metrics: Metrics
+    :param set_limit: called with new limit after each adjustment
+    :type set_limit: Callable[[int], None]
+    :param max_limit: returns upper bound of limit, called at each adjustment so changed config takes effect
+    :type max_limit: Callable[[], int]
+    :param interval: seconds between adjustments
+    :type interval: float
+    """
+
+    initial_limit = 4
+    # Latency up to tolerance times lowest latency is not counted as slowing down
+    tolerance = 2.0
+    # Lowest shrink ratio from latency in one adjustment
+    min_gradient = 0.5
+    # Lowest latency is raised by this ratio each adjustment, so it follows CDN getting slower for good
+    baseline_drift = 1.01
+    # Share of retried requests which cuts limit by decrease_factor
+    error_rate = 0.02
+    decrease_factor = 0.75
+
+    def __init__(self, metrics, set_limit, max_limit, interval=1.0):
+        self.metrics = metrics
+        self.set_limit = set_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.limit = float(min(max_limit(), self.initial_limit))
+        # Lowest latency of page fetch
+        self.baseline = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        """Counters of metrics compared between adjustments
+
+        :return: downloaded pages, fetch seconds, retries, and whether pages are queued
+        :rtype: tuple[int, float, int, bool]
+        """
+        metrics = self.metrics
+        with metrics.lock:
+            return metrics.pages['downloaded'], metrics.seconds['fetch'], metrics.retries, metrics.queued > 0
+
+    def run(self):
+        previous = self.snapshot()
+        while not self.stopped.wait(self.interval):
+            current = self.snapshot()
+            self.update(current[0] - previous[0], current[1] - previous[1], current[2] - previous[2], current[3])
+            previous = current
+
+    def update(self, pages, fetch_seconds, retries, saturated):
+        """Adjust limit from metrics of last interval
+
+        :param pages: number of downloaded pages
+        :type pages: int
+        :param fetch_seconds: total fetch time of downloaded pages
+        :type fetch_seconds: float
+        :param retries: number of retried requests
+        :type retries: int
+        :param saturated: Whether pages are waiting for download slot, limit only grows if so
+        :type saturated: bool
+        """
+        if retries and retries >= self.error_rate * (pages + retries):
+            self.limit = max(1.0, self.limit * self.decrease_factor)
+        elif pages:
+            latency = fetch_seconds / pages
+            if self.baseline is None:
+                self.baseline = latency
+            else:
+                self.baseline = min(self.baseline * self.baseline_drift, latency)
+            gradient = 1.0
+            if latency > 0:
+                gradient = max(self.min_gradient, min(1.0, self.tolerance * self.baseline / latency))
+            limit = self.limit * gradient
+            if saturated:
+                limit += self.limit ** 0.5
+            self.limit = limit
+        else:
+            return
+        self.limit = max(1.0, min(self.max_limit(), self.limit))
+        self.set_limit(round(self.limit))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+class RetryPolicy:
+    """Decide whether to retry a request and how long to wait before it.
+
+    Delays grow exponentially with full jitter, Retry-After header is honored
+    up to the maximum backoff. The retry budget is shared by all workers:
+    failures drain it and successes refill it. While it is below half, every
+    retry waits the maximum backoff, and once it is exhausted requests fail
+    without retrying until successes refill it, so an outage does not turn into
+    all workers retrying.
+
+    :param backoff: Base delay in seconds
+    :type backoff: float
+    :param backoff_max: Maximum delay in seconds
+    :type backoff_max: float
+    :param statuses: Response status codes to retry
+    :type statuses: set[int]
+    :param budget: Size of retry budget, 0 to disable
+    :type budget: int
+    """
+
+    # Statuses of expired or invalid auth, never retried with the same request
+    auth_statuses = {401, 403}
+
+    def __init__(self, backoff, backoff_max, statuses, budget):
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.statuses = statuses
+        self.budget = budget
+        self.tokens = budget
+        self.lock = threading.Lock()
+
+    def should_retry(self, response):
+        """Whether response should be retried
+
+        :type response: httpx.Response
+        :rtype: bool
+        """
+        return response.status_code in self.statuses and response.status_code not in self.auth_statuses
+
+    def retry_after(self, response):
+        """Parse Retry-After header of response
+
+        :type response: httpx.Response
+        :return: Seconds to wait, or None if not available
+        :rtype: float | None
+        """
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, response=None):
+        """Get seconds to wait before next attempt
+
+        :param attempt: Number of failed attempts minus one
+        :type attempt: int
+        :param response: Response of failed attempt, if any
+        :type response: httpx.Response | None
+        :rtype: float
+        """
+        if response is not None:
+            retry_after = self.retry_after(response)
+            if retry_after is not None:
+                return min(self.backoff_max, retry_after)
+        with self.lock:
+            if self.budget and self.tokens < self.budget / 2:
+                return self.backoff_max
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def can_retry(self):
+        """Whether retry budget allows another retry
+
+        :rtype: bool
+        """
+        with self.lock:
+            # Rounded, as tokens are refilled in steps of 0.1
+            return not self.budget or round(self.tokens, 6) >= 1
+
+    def record_failure(self):
+        with self.lock:
+            self.tokens = max(0, self.tokens - 1)
+
+    def record_success(self):
+        with self.lock:
+            self.tokens = min(self.budget, self.tokens + 0.1)
 
 class LockedStatus:
     locked = 0
@@ -676,11 +3548,110 @@ import hashlib
 
 
 
+class GraphQLOperation:
+    """GraphQL operation, with static part of request body serialized once
+
+    :param name: operation name
+    :type name: str
+    :param query: query document
+    :type query: str
+    :param url: URL to send operation to
+    :type url: str
+    """
+
+    def __init__(self, name, query, url):
+        self.name = name
+        self.query = query
+        self.url = url
+        self.sha256 = hashlib.sha256(query.encode()).hexdigest()
+        persisted_query = json.dumps({'persistedQuery': {'version': 1, 'sha256Hash': self.sha256}}, separators=(',', ':'))
+        # Request body is prefix + variables + '}'
+        self.prefix = f'{{"operationName":{json.dumps(name)},"query":{json.dumps(query)},"variables":'.encode()
+        self.persisted_prefix = f'{{"operationName":{json.dumps(name)},"extensions":{persisted_query},"variables":'.encode()
+        self.register_prefix = f'{{"operationName":{json.dumps(name)},"query":{json.dumps(query)},"extensions":{persisted_query},"variables":'.encode()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def body(self, variables, prefix=None):
+        """Create request body
+
+        :param variables: variables of operation
+        :type variables: dict
+        :param prefix: one of prefix, persisted_prefix and register_prefix, default prefix
+        :type prefix: bytes | None
+        :rtype: bytes
+        """
+        return (prefix or self.prefix) + json.dumps(variables, separators=(',', ':'), ensure_ascii=False).encode() + b'}'
+
+    def record(self, seconds, bytes_sent, bytes_received):
+        with self.lock:
+            self.count += 1
+            self.seconds += seconds
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+
+class GraphQLRegistry:
+    """Registry of GraphQL operations of an API endpoint
+
+    :param endpoint: URL of GraphQL endpoint
+    :type endpoint: str
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.operations = {}
+
+    def register(self, name, query, key=None, url=None):
+        """Register operation
+
+        :param name: operation name
+        :type name: str
+        :param query: query document
+        :type query: str
+        :param key: key of operation in registry, default name
+        :type key: str | None
+        :param url: URL to send operation to, default endpoint?name
+        :type url: str | None
+        """
+        self.operations[key or name] = GraphQLOperation(name, query, url or f'{self.endpoint}?{name}')
+
+    def __contains__(self, key):
+        return key in self.operations
+
+    def __getitem__(self, key):
+        return self.operations[key]
+
+    def print_stats(self):
+        """Print request count, latency and payload size of each operation"""
+        for key, operation in self.operations.items():
+            if operation.count:
+                print(f'{key}: {operation.count}次，平均{operation.seconds / operation.count * 1000:.0f}毫秒，'
+                      f'上傳{operation.bytes_sent}位元組，下載{operation.bytes_received}位元組')
+
+QUERIES = GraphQLRegistry('https://shonenjumpplus.com/api/v1/graphql')
+QUERIES.register('SeriesDetailEpisodeList', 'query SeriesDetailEpisodeList($id: String!, $episodeOffset: Int = 0 , $episodeFirst: Int = 100 , $episodeSort: ReadableProductSorting = null ) { series(databaseId: $id) { __typename id databaseId publisherId title episodeDefaultSorting episodes: readableProducts(types: [EPISODE,SPECIAL_CONTENT], first: $episodeFirst, offset: $episodeOffset, sort: $episodeSort) { totalCount pageInfo { __typename ...ForwardPageInfo } edges { node { __typename id databaseId ...EpisodeListItem ...SpecialContentListItem } } } ...SeriesDetailBottomBanners } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment EpisodeIsViewed on Episode { id databaseId isViewed }  fragment EpisodeListItem on Episode { __typename id databaseId publisherId title subtitle thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility publishedAt isSakiyomi completeReadingInfo { visitorCanGetPoint gettablePoint } viewCount series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } ...EpisodeIsViewed }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment SpecialContentListItem on SpecialContent { __typename id databaseId publisherId title thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility publishedAt linkUrl series { id databaseId publisherId title serialUpdateScheduleLabel } ...AnalyticsParameters }  fragment SeriesDetailBottomBanners on Series { id databaseId bannerGroup(groupName: "series_detail_bottom") { __typename ... on ImageBanner { databaseId imageUriTemplate imageUrl linkUrl } ... on YouTubeBanner { videoId } } }')
+QUERIES.register('SeriesDetailVolumeList', 'query SeriesDetailVolumeList($id: String!, $volumeOffset: Int = 0 , $volumeFirst: Int = 100 , $volumeSort: ReadableProductSorting = NUMBER_DESC ) { series(databaseId: $id) { __typename id databaseId volumes: readableProducts(types: [VOLUME], first: $volumeFirst, offset: $volumeOffset, sort: $volumeSort) { __typename ...BookVolumeList } volumesBulkPurchaseItem: firstVolume { __typename id databaseId ...BookBulkPurchaseItem } volumeSeries { id publisherId title } hasEpisode: hasPublicReadableProduct(type: EPISODE) ...SeriesDetailBottomBanners } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment VolumeReadTrialAvailability on Volume { accessibility trialPageImages(first: 0) { totalCount } }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment BookListItem on ReadableProduct { __typename id publisherId databaseId title thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility ... on Volume { __typename description series { id databaseId } ...VolumeReadTrialAvailability } ... on Ebook { description series { id databaseId publisherId title } } ...AnalyticsParameters }  fragment BookVolumeList on ReadableProductConnection { pageInfo { __typename ...ForwardPageInfo } totalCount edges { node { __typename id databaseId ...BookListItem } } }  fragment BookBulkPurchaseItem on ReadableProduct { __typename id databaseId publisherId thumbnailUriTemplate title accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Volume { number series { id databaseId volumeSeries { id databaseId title author { id databaseId name } } } } }  fragment SeriesDetailBottomBanners on Series { id databaseId bannerGroup(groupName: "series_detail_bottom") { __typename ... on ImageBanner { databaseId imageUriTemplate imageUrl linkUrl } ... on YouTubeBanner { videoId } } }')
+QUERIES.register('EpisodeViewerConditionallyCacheable', 'query EpisodeViewerConditionallyCacheable($episodeID: String!) { episode(databaseId: $episodeID) { id databaseId pageImages { totalCount edges { node { src width height tshirtUrl clickableAreas { __typename ...ClickableArea } } } } purchaseInfo { __typename ...PurchaseInfo } } }  fragment ClickableArea on Clickable { __typename appUrl position { __typename ... on PageIndexReadableProductPosition { pageIndex: index } ... on CFIReadableProductPosition { cfi } } ... on ClickableRect { height left top width } }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }')
+QUERIES.register('ConsumeOnetimeFree', 'mutation ConsumeOnetimeFree($input: ConsumeOnetimeFreeInput!) { consumeOnetimeFree(input: $input) { isSuccess readableProduct { databaseId id accessibility purchaseInfo { __typename ...PurchaseInfo } } } }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }')
+QUERIES.register('VolumeViewer', 'query VolumeViewer($volumeID: String!) { volume(databaseId: $volumeID) { __typename id ...CommonVolumeViewer pageImages { totalCount edges { node { src width height tshirtUrl clickableAreas { __typename ...ClickableArea } } } } packedImage { url } tableOfContents { title position { index } } previous { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } ...ViewerLink } next { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } ...ViewerLink } viewHistory { __typename ...RemoteViewHistory } ...VolumeImprintPage ...CommonReadableProductViewer } }  fragment SpineItem on Spine { readingDirection startPosition }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment CommonVolumeViewer on Volume { id databaseId publisherId title permalink number pageImageToken thumbnailUri spine { __typename ...SpineItem } openAt closeAt series { id databaseId mylisted volumeSeries { id databaseId publisherId title author { id databaseId name } } } purchaseInfo { __typename ...PurchaseInfo } }  fragment ClickableArea on Clickable { __typename appUrl position { __typename ... on PageIndexReadableProductPosition { pageIndex: index } ... on CFIReadableProductPosition { cfi } } ... on ClickableRect { height left top width } }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment ViewerLink on ReadableProduct { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } accessibility ... on Episode { publisherId } ... on Magazine { publisherId } ... on Volume { publisherId } ...AnalyticsParameters }  fragment RemoteViewHistory on ReadableProductViewHistory { lastViewedAt lastViewedPosition { __typename ... on PageIndexReadableProductPosition { index } } }  fragment ImprintPageNextContent on ReadableProduct { __typename id databaseId title thumbnailUriTemplate accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Magazine { isSubscribersOnly } ...AnalyticsParameters }  fragment VolumeImprintPage on Volume { id databaseId next { __typename id databaseId series { id databaseId } ...ImprintPageNextContent } }  fragment EpisodeShareContent on Episode { id databaseId title shareUrl permalink series { id databaseId title } }  fragment ReadableProductShareContent on ReadableProduct { __typename id databaseId ... on Ebook { title shareUrl } ... on Episode { __typename ...EpisodeShareContent } ... on Magazine { title permalink shareUrl } ... on Volume { title permalink shareUrl } }  fragment CommonReadableProductViewer on ReadableProduct { __typename id databaseId accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Episode { id databaseId pageImages { totalCount } } ... on Magazine { id databaseId pageImages { totalCount } } ... on Volume { id databaseId pageImages { totalCount } } ...ReadableProductShareContent ...AnalyticsParameters }')
+QUERIES.register('BookshelfPurchasedShelfByType', 'query BookshelfPurchasedShelfByType($type: ReadableProductType!, $after: String, $first: Int! = 30 , $sort: PurchasedReadableProductParentSorting! = VIEWED_AT_DESC ) { userAccount { databaseId isLoggedIn purchasedReadableProductParents(type: $type, first: $first, after: $after, sort: $sort) { pageInfo { __typename ...ForwardPageInfo } edges { node { __typename id ...BookshelfReadableProductParentItem latestPurchasedReadableProduct: purchasedReadableProducts(first: 1, sort: NUMBER_DESC, type: $type) { edges { node { id databaseId thumbnailUriTemplate } } } } } } } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment BookshelfReadableProductParentItem on ReadableProductParent { __typename ... on MagazineLabel { id magazineLabelDatabaseId: databaseId title } ... on Series { id seriesDatabaseId: databaseId thumbnailUriTemplate author { id databaseId name } volumeSeries { id databaseId title } } }', url='https://shonenjumpplus.com/api/v1/graphql?opname=BookshelfPurchasedShelfByType')
+QUERIES.register('SearchResult', 'query SearchResult($after: String, $keyword: String!) { search(after: $after, first: 50, keyword: $keyword, types: [SERIES,MAGAZINE_LABEL]) { pageInfo { __typename ...ForwardPageInfo } edges { node { __typename ...SearchResultItem } } } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment SerialInfoIcon on SerialInfo { isOriginal isIndies }  fragment SearchResultSeriesItem on Series { id databaseId thumbnailUriTemplate title author { id databaseId name } supportsOnetimeFree serialInfo { __typename ...SerialInfoIcon status } hasEpisode: hasPublicReadableProduct(type: EPISODE) hasEbook: hasPublicReadableProduct(type: EBOOK) hasVolume: hasPublicReadableProduct(type: VOLUME) hasSpecialContent: hasPublicReadableProduct(type: SPECIAL_CONTENT) readableProducts(first: 1, sort: NUMBER_DESC, types: [VOLUME,EBOOK]) { edges { node { id databaseId thumbnailUriTemplate } } } }  fragment SearchResultItem on ReadableProductParent { __typename ... on Series { __typename id publisherId seriesDatabaseId: databaseId ...SearchResultSeriesItem } ... on MagazineLabel { id magazineLabelDatabaseId: databaseId title publisherId latestIssue { id databaseId thumbnailUriTemplate } } }')
+QUERIES.register('EpisodeViewer', 'query EpisodeViewer($episodeID: String!) { episode(databaseId: $episodeID) { id databaseId publisherId title number publishedAt pageImageToken spine { readingDirection startPosition } previousSpecialContent { id databaseId linkUrl } nextSpecialContent { id databaseId linkUrl } series { id databaseId publisherId title author { id databaseId name } serialUpdateScheduleLabel jamEpisodeWorkType openAt } } stampCard { __typename ...StampCardIcon } }  fragment StampCardIcon on StampCard { id databaseId iconImageUrl }')
+
 class Extractor(ExtractorBase):
     name = 'jumpplus'
 
-    def __init__(self):
-        super().__init__()
+    # Fields of episode and volume needed for download, used by batched query
+    batch_episode_fields = 'id databaseId title number pageImageToken series { id title } pageImages { totalCount edges { node { src } } } purchaseInfo { purchasableViaOnetimeFree }'
+    batch_volume_fields = 'id databaseId title number pageImageToken series { id title } pageImages { totalCount edges { node { src } } } packedImage { url }'
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        # Set to False if server rejects batched query
+        self.batch_query_supported = True
         try:
             self.app_version, self.authorization = self.token.splitlines()
             self.device_id = hashlib.md5(self.authorization.encode()).hexdigest()[:16]
@@ -693,29 +3664,91 @@ class Extractor(ExtractorBase):
         except:
             pass
 
+    def main(self):
+        super().main()
+        if self.config['graphql_stats']:
+            QUERIES.print_stats()
+
+    def graphql(self, key, variables):
+        """Send registered GraphQL operation. With persisted_queries, only hash of
+        query is sent, and query is sent only if server does not know the hash yet
+
+        :param key: key of operation in QUERIES
+        :type key: str
+        :param variables: variables of operation
+        :type variables: dict
+        :return: decoded response
+        :rtype: dict
+        """
+        operation = QUERIES[key]
+        headers = dict(self.headers)
+        headers['content-type'] = 'application/json'
+
+        def send(prefix):
+            body = operation.body(variables, prefix)
+            start = time.perf_counter()
+            response = self.post_request(operation.url, content=body, headers=headers)
+            operation.record(time.perf_counter() - start, len(body), len(response.content))
+            return self.json_loads(response.content)
+
+        if self.config['persisted_queries']:
+            # Operation is sent again only if server did not run it, so mutations are not repeated
+            j = send(operation.persisted_prefix)
+            error = self.persisted_query_error(j)
+            if error is None and j.get('data') is None:
+                # Server without persisted queries may answer hash with unrelated error like
+                # missing query. It had no query to run, so sending query once is safe
+                j = send(operation.prefix)
+                if j.get('data') is not None:
+                    print('伺服器不支持persisted query')
+                    self.config['persisted_queries'] = False
+                return j
+            if error == 'not_found':
+                j = send(operation.register_prefix)
+                error = self.persisted_query_error(j)
+            if error is None:
+                return j
+            print('伺服器不支持persisted query')
+            self.config['persisted_queries'] = False
+        return send(operation.prefix)
+
+    def persisted_query_error(self, j):
+        """Find error of persisted query in GraphQL response
+
+        :param j: decoded response
+        :type j: dict
+        :return: not_found if server does not know the hash yet, not_supported if
+            server rejects persisted query or hash, None for other responses
+        :rtype: str | None
+        """
+        for error in j.get('errors') or []:
+            code = (error.get('extensions') or {}).get('code')
+            message = error.get('message', '')
+            if code == 'PERSISTED_QUERY_NOT_FOUND' or message == 'PersistedQueryNotFound':
+                return 'not_found'
+            if (code in ('PERSISTED_QUERY_NOT_SUPPORTED', 'PERSISTED_QUERY_HASH_MISMATCH')
+                    or message in ('PersistedQueryNotSupported', 'provided sha does not match query')):
+                return 'not_supported'
+        return None
+
     def show_help(self):
         print(self.create_help('''VERSION GLSC
     VERSION是安卓端最新版本號，另外在網頁版登錄，填入 glsc 這個 cookie''', True, True, False))
 
-    def getChapterList(self, comic_id):
-        json_data = {
-            'operationName': 'SeriesDetailEpisodeList',
-            'variables': {
+    def fetchChapterList(self, comic_id):
+        def fetch_episodes(offset, first):
+            j = self.graphql('SeriesDetailEpisodeList', {
                 'id': comic_id,
-                'episodeOffset': 0,
-                'episodeFirst': 1000,
+                'episodeOffset': offset,
+                'episodeFirst': first,
                 'episodeSort': 'NUMBER_ASC',
-            },
-            'query': 'query SeriesDetailEpisodeList($id: String!, $episodeOffset: Int = 0 , $episodeFirst: Int = 100 , $episodeSort: ReadableProductSorting = null ) { series(databaseId: $id) { __typename id databaseId publisherId title episodeDefaultSorting episodes: readableProducts(types: [EPISODE,SPECIAL_CONTENT], first: $episodeFirst, offset: $episodeOffset, sort: $episodeSort) { totalCount pageInfo { __typename ...ForwardPageInfo } edges { node { __typename id databaseId ...EpisodeListItem ...SpecialContentListItem } } } ...SeriesDetailBottomBanners } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment EpisodeIsViewed on Episode { id databaseId isViewed }  fragment EpisodeListItem on Episode { __typename id databaseId publisherId title subtitle thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility publishedAt isSakiyomi completeReadingInfo { visitorCanGetPoint gettablePoint } viewCount series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } ...EpisodeIsViewed }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment SpecialContentListItem on SpecialContent { __typename id databaseId publisherId title thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility publishedAt linkUrl series { id databaseId publisherId title serialUpdateScheduleLabel } ...AnalyticsParameters }  fragment SeriesDetailBottomBanners on Series { id databaseId bannerGroup(groupName: "series_detail_bottom") { __typename ... on ImageBanner { databaseId imageUriTemplate imageUrl linkUrl } ... on YouTubeBanner { videoId } } }',
-        }
+            })
+            if not 'data' in j:
+                raise Exception(j['message'])
+            return j['data']['series']['episodes']
 
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?SeriesDetailEpisodeList', headers=self.headers, json=json_data)
-        j = response.json()
-        if not 'data' in j:
-            raise Exception(j['message'])
-        chapters = j['data']['series']['episodes']['edges']
         ret = []
-        for chapter in chapters:
+        for chapter in self.fetch_all_pages(fetch_episodes):
             title = chapter['node']['title']
             subtitle = chapter['node'].get('subtitle')
             if subtitle:
@@ -725,79 +3758,165 @@ class Extractor(ExtractorBase):
             locked_status = self.getLockedStatus(chapter['node']['purchaseInfo'])
             ret.append(Chapter(chapter['node']['databaseId'], title, locked_status))
 
-        json_data = {
-            'operationName': 'SeriesDetailVolumeList',
-            'variables': {
+        def fetch_volumes(offset, first):
+            j = self.graphql('SeriesDetailVolumeList', {
                 'id': comic_id,
+                'volumeOffset': offset,
+                'volumeFirst': first,
                 'volumeSort': 'NUMBER_ASC',
-            },
-            'query': 'query SeriesDetailVolumeList($id: String!, $volumeSort: ReadableProductSorting = NUMBER_DESC ) { series(databaseId: $id) { __typename id databaseId volumes: readableProducts(types: [VOLUME], first: 100, sort: $volumeSort) { __typename ...BookVolumeList } volumesBulkPurchaseItem: firstVolume { __typename id databaseId ...BookBulkPurchaseItem } volumeSeries { id publisherId title } hasEpisode: hasPublicReadableProduct(type: EPISODE) ...SeriesDetailBottomBanners } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment VolumeReadTrialAvailability on Volume { accessibility trialPageImages(first: 0) { totalCount } }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment BookListItem on ReadableProduct { __typename id publisherId databaseId title thumbnailUriTemplate purchaseInfo { __typename ...PurchaseInfo } accessibility ... on Volume { __typename description series { id databaseId } ...VolumeReadTrialAvailability } ... on Ebook { description series { id databaseId publisherId title } } ...AnalyticsParameters }  fragment BookVolumeList on ReadableProductConnection { pageInfo { __typename ...ForwardPageInfo } totalCount edges { node { __typename id databaseId ...BookListItem } } }  fragment BookBulkPurchaseItem on ReadableProduct { __typename id databaseId publisherId thumbnailUriTemplate title accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Volume { number series { id databaseId volumeSeries { id databaseId title author { id databaseId name } } } } }  fragment SeriesDetailBottomBanners on Series { id databaseId bannerGroup(groupName: "series_detail_bottom") { __typename ... on ImageBanner { databaseId imageUriTemplate imageUrl linkUrl } ... on YouTubeBanner { videoId } } }',
-        }
+            })
+            return j['data']['series']['volumes']
 
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?SeriesDetailVolumeList', headers=self.headers, json=json_data)
-        j = response.json()
-        chapters = j['data']['series']['volumes']['edges']
-        for chapter in chapters:
+        for chapter in self.fetch_all_pages(fetch_volumes):
             locked_status = self.getLockedStatus(chapter['node']['purchaseInfo'])
             ret.append(Chapter(chapter['node']['databaseId'], chapter['node']['title'], locked_status))
 
         return ret
 
-    def downloadChapter(self, comic_id, chapter_id, root):
+    def fetch_all_pages(self, fetch):
+        """Fetch all edges of paginated connection. First page tells totalCount,
+        remaining pages are fetched concurrently and merged in order
+
+        :param fetch: Function fetching connection with given offset and page size
+        :type fetch: Callable[[int, int], dict]
+        :return: edges of connection
+        :rtype: list[dict]
+        """
+        page_size = self.config['chapter_page_size']
+        connection = fetch(0, page_size)
+        edges = connection['edges']
+        offsets = range(page_size, connection['totalCount'], page_size)
+        if offsets:
+            with ThreadPoolExecutor(max_workers=min(len(offsets), self.config['threads'])) as page_pool:
+                for connection in page_pool.map(lambda offset: fetch(offset, page_size), offsets):
+                    edges += connection['edges']
+        return edges
+
+    def prepareChapter(self, comic_id, chapter_id, root):
         comic_title, chapter_title, image_token, number = self.getChapterInfo(comic_id, chapter_id)
         if not comic_title:
             # Not episode, probably volume or special content
-            self.downloadVolume(comic_id, chapter_id, root)
-            return
+            return self.prepareVolume(comic_id, chapter_id, root)
 
-        json_data = {
-            'operationName': 'EpisodeViewerConditionallyCacheable',
-            'variables': {
-                'episodeID': chapter_id,
-            },
-            'query': 'query EpisodeViewerConditionallyCacheable($episodeID: String!) { episode(databaseId: $episodeID) { id databaseId pageImages { totalCount edges { node { src width height tshirtUrl clickableAreas { __typename ...ClickableArea } } } } purchaseInfo { __typename ...PurchaseInfo } } }  fragment ClickableArea on Clickable { __typename appUrl position { __typename ... on PageIndexReadableProductPosition { pageIndex: index } ... on CFIReadableProductPosition { cfi } } ... on ClickableRect { height left top width } }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }',
-        }
-
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?EpisodeViewerConditionallyCacheable', headers=self.headers, json=json_data)
-        j = response.json()
+        j = self.graphql('EpisodeViewerConditionallyCacheable', {
+            'episodeID': chapter_id,
+        })
         if not j['data']['episode']['pageImages']:
             if not j['data']['episode']['purchaseInfo']['purchasableViaOnetimeFree']:
                 raise Exception(j['errors'][0]['message'])
             # Try unlocking chapter with one-time-free
             print('嘗試自動解鎖初回無料章節', chapter_title)
-            json_data_one_time_free = {
-                'operationName': 'ConsumeOnetimeFree',
-                'variables': {
-                    'input': {
-                        'id': j['data']['episode']['id'],
-                    },
+            self.graphql('ConsumeOnetimeFree', {
+                'input': {
+                    'id': j['data']['episode']['id'],
                 },
-                'query': 'mutation ConsumeOnetimeFree($input: ConsumeOnetimeFreeInput!) { consumeOnetimeFree(input: $input) { isSuccess readableProduct { databaseId id accessibility purchaseInfo { __typename ...PurchaseInfo } } } }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }',
-            }
-
-            self.post_request('https://shonenjumpplus.com/api/v1/graphql?ConsumeOnetimeFree', headers=self.headers, json=json_data_one_time_free)
+            })
+            self.invalidateChapterList(comic_id)
             # I am not checking response of this request, instead checking images availability
-            response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?EpisodeViewerConditionallyCacheable', headers=self.headers, json=json_data)
-            j = response.json()
+            j = self.graphql('EpisodeViewerConditionallyCacheable', {
+                'episodeID': chapter_id,
+            })
             if not j['data']['episode']['pageImages']:
                 raise Exception(j['errors'][0]['message'])
         image_download = ImageDownload(root, comic_title, f'{number} {chapter_title}')
         image_headers = {'X-GIGA-PAGE-IMAGE-AUTH': image_token}
         for i in j['data']['episode']['pageImages']['edges']:
             image_download.requests.append(self.client.build_request('GET', i['node']['src'], headers=image_headers))
-        self.download_list(image_download)
+        return image_download
+
+    def prepareChapters(self, jobs):
+        # Fetch episode and volume information with images of all chapters in one
+        # aliased query, instead of EpisodeViewer, EpisodeViewerConditionallyCacheable
+        # and VolumeViewer for each chapter
+        if not self.batch_query_supported:
+            return super().prepareChapters(jobs)
+        variables = {}
+        fields = []
+        for i, (comic_id, chapter_id, root) in enumerate(jobs):
+            variables[f'id{i}'] = chapter_id
+            fields.append(f'e{i}: episode(databaseId: $id{i}) {{ {self.batch_episode_fields} }}')
+            fields.append(f'v{i}: volume(databaseId: $id{i}) {{ {self.batch_volume_fields} }}')
+        arguments = ', '.join(f'${name}: String!' for name in variables)
+        fields = ' '.join(fields)
+        key = f'ChapterBatch{len(jobs)}'
+        if key not in QUERIES:
+            QUERIES.register('ChapterBatch', f'query ChapterBatch({arguments}) {{ {fields} }}', key=key)
+        j = self.graphql(key, variables)
+        if not j.get('data'):
+            if self.is_schema_error(j):
+                print('伺服器不支持合併查詢，改用個別查詢')
+                self.batch_query_supported = False
+            # Other errors, e.g. auth or rate limit, only affect this batch
+            return super().prepareChapters(jobs)
+        # Alias -> error message
+        errors = {}
+        for error in j.get('errors') or []:
+            if error.get('path'):
+                errors.setdefault(error['path'][0], error['message'])
+        results = []
+        for i, job in enumerate(jobs):
+            try:
+                results.append(self.parseBatchedChapter(j['data'], i, errors, *job))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def is_schema_error(self, j):
+        """Whether GraphQL response failed because server does not accept the query itself
+
+        :param j: decoded response
+        :type j: dict
+        :rtype: bool
+        """
+        for error in j.get('errors') or []:
+            code = (error.get('extensions') or {}).get('code')
+            if code in ('GRAPHQL_VALIDATION_FAILED', 'GRAPHQL_PARSE_FAILED'):
+                return True
+            if error.get('message', '').startswith(('Cannot query field', 'Unknown argument', 'Syntax Error')):
+                return True
+        return False
+
+    def parseBatchedChapter(self, data, i, errors, comic_id, chapter_id, root):
+        """Create ImageDownload from result of batched query made by prepareChapters()"""
+        episode = data.get(f'e{i}')
+        volume = data.get(f'v{i}')
+        if episode:
+            if not episode['pageImages']:
+                if episode['purchaseInfo']['purchasableViaOnetimeFree']:
+                    # Unlock with separate queries
+                    return self.prepareChapter(comic_id, chapter_id, root)
+                raise Exception(errors.get(f'e{i}', '無法獲得圖片'))
+            chapter_title = episode['title']
+            for chapter in self.getChapterList(comic_id):
+                if chapter_id == chapter.chapter_id:
+                    chapter_title = chapter.title
+                    break
+            number = str(episode['number']).zfill(3)
+            image_download = ImageDownload(root, episode['series']['title'], f'{number} {chapter_title}')
+            product = episode
+        elif volume:
+            if not volume['pageImages']:
+                raise Exception(errors.get(f'v{i}', '無法獲得圖片'))
+            number = str(volume['number']).zfill(2)
+            image_download = ImageDownload(root, volume['series']['title'], f'Vol.{number} {volume["title"]}')
+            product = volume
+        else:
+            # Not episode or volume, probably special content
+            raise Exception('不支持下載特別內容')
+        image_headers = {'X-GIGA-PAGE-IMAGE-AUTH': product['pageImageToken']}
+        for edge in product['pageImages']['edges']:
+            image_download.requests.append(self.client.build_request('GET', edge['node']['src'], headers=image_headers))
+        if product is volume:
+            image_download.packed_request = self.packed_request(volume, image_headers)
+        return image_download
 
     def downloadVolume(self, comic_id, chapter_id, root):
-        json_data = {
-            'operationName': 'VolumeViewer',
-            'variables': {
-                'volumeID': chapter_id,
-            },
-            'query': 'query VolumeViewer($volumeID: String!) { volume(databaseId: $volumeID) { __typename id ...CommonVolumeViewer pageImages { totalCount edges { node { src width height tshirtUrl clickableAreas { __typename ...ClickableArea } } } } packedImage { url } tableOfContents { title position { index } } previous { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } ...ViewerLink } next { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } ...ViewerLink } viewHistory { __typename ...RemoteViewHistory } ...VolumeImprintPage ...CommonReadableProductViewer } }  fragment SpineItem on Spine { readingDirection startPosition }  fragment PurchaseInfo on PurchaseInfo { isFree hasPurchased hasPurchasedViaTicket purchasable purchasableViaTicket purchasableViaPaidPoint purchasableViaOnetimeFree unitPrice rentable rentalEndAt hasRented rentableByPaidPointOnly rentalTermMin }  fragment CommonVolumeViewer on Volume { id databaseId publisherId title permalink number pageImageToken thumbnailUri spine { __typename ...SpineItem } openAt closeAt series { id databaseId mylisted volumeSeries { id databaseId publisherId title author { id databaseId name } } } purchaseInfo { __typename ...PurchaseInfo } }  fragment ClickableArea on Clickable { __typename appUrl position { __typename ... on PageIndexReadableProductPosition { pageIndex: index } ... on CFIReadableProductPosition { cfi } } ... on ClickableRect { height left top width } }  fragment AnalyticsParameters on ReadableProduct { __typename id databaseId publisherId title ... on Episode { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } ... on Volume { openAt series { id databaseId publisherId title } } ... on Ebook { publishedAt series { id databaseId publisherId title } } ... on Magazine { openAt magazineLabel { id databaseId publisherId title } } ... on SpecialContent { publishedAt series { id databaseId publisherId title serialUpdateScheduleLabel jamEpisodeWorkType } } }  fragment ViewerLink on ReadableProduct { __typename id databaseId purchaseInfo { __typename ...PurchaseInfo } accessibility ... on Episode { publisherId } ... on Magazine { publisherId } ... on Volume { publisherId } ...AnalyticsParameters }  fragment RemoteViewHistory on ReadableProductViewHistory { lastViewedAt lastViewedPosition { __typename ... on PageIndexReadableProductPosition { index } } }  fragment ImprintPageNextContent on ReadableProduct { __typename id databaseId title thumbnailUriTemplate accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Magazine { isSubscribersOnly } ...AnalyticsParameters }  fragment VolumeImprintPage on Volume { id databaseId next { __typename id databaseId series { id databaseId } ...ImprintPageNextContent } }  fragment EpisodeShareContent on Episode { id databaseId title shareUrl permalink series { id databaseId title } }  fragment ReadableProductShareContent on ReadableProduct { __typename id databaseId ... on Ebook { title shareUrl } ... on Episode { __typename ...EpisodeShareContent } ... on Magazine { title permalink shareUrl } ... on Volume { title permalink shareUrl } }  fragment CommonReadableProductViewer on ReadableProduct { __typename id databaseId accessibility purchaseInfo { __typename ...PurchaseInfo } ... on Episode { id databaseId pageImages { totalCount } } ... on Magazine { id databaseId pageImages { totalCount } } ... on Volume { id databaseId pageImages { totalCount } } ...ReadableProductShareContent ...AnalyticsParameters }',
-        }
+        self.download_list(self.prepareVolume(comic_id, chapter_id, root))
 
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?VolumeViewer', headers=self.headers, json=json_data)
-        j = response.json()
+    def prepareVolume(self, comic_id, chapter_id, root):
+        j = self.graphql('VolumeViewer', {
+            'volumeID': chapter_id,
+        })
         if not j['data']['volume']:
             # Not volume, probably special content
             raise Exception('不支持下載特別內容')
@@ -811,56 +3930,60 @@ class Extractor(ExtractorBase):
             raise Exception(j['errors'][0]['message'])
         for i in j['data']['volume']['pageImages']['edges']:
             image_download.requests.append(self.client.build_request('GET', i['node']['src'], headers=image_headers))
-        self.download_list(image_download)
+        image_download.packed_request = self.packed_request(j['data']['volume'], image_headers)
+        return image_download
+
+    def packed_request(self, volume, image_headers):
+        """Request of packedImage of volume, if packed_images is enabled
+
+        :param volume: volume in GraphQL response
+        :type volume: dict
+        :param image_headers: headers of image requests
+        :type image_headers: dict
+        :rtype: httpx.Request | None
+        """
+        packed_image = volume.get('packedImage')
+        if not self.config['packed_images'] or not packed_image or not packed_image.get('url'):
+            return None
+        return self.client.build_request('GET', packed_image['url'], headers=image_headers)
 
     def getBoughtComicList(self):
-        json_data = {
-            'operationName': 'BookshelfPurchasedShelfByType',
-            'variables': {
+        after = None
+        while True:
+            j = self.graphql('BookshelfPurchasedShelfByType', {
                 'type': 'VOLUME',
                 'sort': 'PURCHASED_AT_DESC',
-            },
-            'query': 'query BookshelfPurchasedShelfByType($type: ReadableProductType!, $after: String, $first: Int! = 30 , $sort: PurchasedReadableProductParentSorting! = VIEWED_AT_DESC ) { userAccount { databaseId isLoggedIn purchasedReadableProductParents(type: $type, first: $first, after: $after, sort: $sort) { pageInfo { __typename ...ForwardPageInfo } edges { node { __typename id ...BookshelfReadableProductParentItem latestPurchasedReadableProduct: purchasedReadableProducts(first: 1, sort: NUMBER_DESC, type: $type) { edges { node { id databaseId thumbnailUriTemplate } } } } } } } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment BookshelfReadableProductParentItem on ReadableProductParent { __typename ... on MagazineLabel { id magazineLabelDatabaseId: databaseId title } ... on Series { id seriesDatabaseId: databaseId thumbnailUriTemplate author { id databaseId name } volumeSeries { id databaseId title } } }',
-        }
-
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?opname=BookshelfPurchasedShelfByType', headers=self.headers, json=json_data)
-        j = response.json()
-        if not 'data' in j:
-            raise Exception(j['message'])
-        ret = []
-        for comic in j['data']['userAccount']['purchasedReadableProductParents']['edges']:
-            ret.append(Comic(comic['node']['seriesDatabaseId'], comic['node']['volumeSeries']['title']))
-        return ret
+                'after': after,
+            })
+            if not 'data' in j:
+                raise Exception(j['message'])
+            connection = j['data']['userAccount']['purchasedReadableProductParents']
+            for comic in connection['edges']:
+                yield Comic(comic['node']['seriesDatabaseId'], comic['node']['volumeSeries']['title'])
+            if not connection['pageInfo']['hasNextPage']:
+                return
+            after = connection['pageInfo']['endCursor']
 
     def searchComic(self, query):
-        json_data = {
-            'operationName': 'SearchResult',
-            'variables': {
+        after = None
+        while True:
+            j = self.graphql('SearchResult', {
                 'keyword': query,
-            },
-            'query': 'query SearchResult($after: String, $keyword: String!) { search(after: $after, first: 50, keyword: $keyword, types: [SERIES,MAGAZINE_LABEL]) { pageInfo { __typename ...ForwardPageInfo } edges { node { __typename ...SearchResultItem } } } }  fragment ForwardPageInfo on PageInfo { hasNextPage endCursor }  fragment SerialInfoIcon on SerialInfo { isOriginal isIndies }  fragment SearchResultSeriesItem on Series { id databaseId thumbnailUriTemplate title author { id databaseId name } supportsOnetimeFree serialInfo { __typename ...SerialInfoIcon status } hasEpisode: hasPublicReadableProduct(type: EPISODE) hasEbook: hasPublicReadableProduct(type: EBOOK) hasVolume: hasPublicReadableProduct(type: VOLUME) hasSpecialContent: hasPublicReadableProduct(type: SPECIAL_CONTENT) readableProducts(first: 1, sort: NUMBER_DESC, types: [VOLUME,EBOOK]) { edges { node { id databaseId thumbnailUriTemplate } } } }  fragment SearchResultItem on ReadableProductParent { __typename ... on Series { __typename id publisherId seriesDatabaseId: databaseId ...SearchResultSeriesItem } ... on MagazineLabel { id magazineLabelDatabaseId: databaseId title publisherId latestIssue { id databaseId thumbnailUriTemplate } } }',
-        }
-
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?SearchResult', headers=self.headers, json=json_data)
-        j = response.json()
-        if not 'data' in j:
-            raise Exception(j['message'])
-        ret = []
-        for comic in j['data']['search']['edges']:
-            ret.append(Comic(comic['node']['seriesDatabaseId'], comic['node']['title']))
-        return ret
+                'after': after,
+            })
+            if not 'data' in j:
+                raise Exception(j['message'])
+            connection = j['data']['search']
+            for comic in connection['edges']:
+                yield Comic(comic['node']['seriesDatabaseId'], comic['node']['title'])
+            if not connection['pageInfo']['hasNextPage']:
+                return
+            after = connection['pageInfo']['endCursor']
 
     def getChapterInfo(self, comic_id, chapter_id):
-        json_data = {
-            'operationName': 'EpisodeViewer',
-            'variables': {
-                'episodeID': chapter_id,
-            },
-            'query': 'query EpisodeViewer($episodeID: String!) { episode(databaseId: $episodeID) { id databaseId publisherId title number publishedAt pageImageToken spine { readingDirection startPosition } previousSpecialContent { id databaseId linkUrl } nextSpecialContent { id databaseId linkUrl } series { id databaseId publisherId title author { id databaseId name } serialUpdateScheduleLabel jamEpisodeWorkType openAt } } stampCard { __typename ...StampCardIcon } }  fragment StampCardIcon on StampCard { id databaseId iconImageUrl }',
-        }
-
-        response = self.post_request('https://shonenjumpplus.com/api/v1/graphql?EpisodeViewer', headers=self.headers, json=json_data)
-        j = response.json()
+        j = self.graphql('EpisodeViewer', {
+            'episodeID': chapter_id,
+        })
         if not j['data']['episode']:
             # Not episode, probably volume or special content
             return None, None, None, None